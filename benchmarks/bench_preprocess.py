@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compare the single pass preprocessor with the previous two scan, per macro
+substitution path, checking both give the same markdown.
+
+    python benchmarks/bench_preprocess.py --lines 20000 --macros 300
+"""
+import argparse
+import ast
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx  # noqa: E402
+
+
+def legacy_preprocess(file_name, macros):
+    """The preprocessing path as it was before the single pass scan: one read for
+    the macros, one for the markdown, then a find/replace per macro per line."""
+    with open(file_name) as f:
+        in_a_macro_block = False
+        for line in f:
+            line = line.strip()
+            if line.startswith("MaCrOs"):
+                in_a_macro_block = True
+                continue
+            if line.startswith("END_MaCrOs"):
+                in_a_macro_block = False
+            if line and in_a_macro_block and not line.startswith(("#", "//")):
+                ast.literal_eval(line)
+    markdown = []
+    with open(file_name) as f:
+        in_a_macro_block = False
+        for line in f:
+            line_copy = line.strip()
+            if line_copy.startswith("MaCrOs"):
+                in_a_macro_block = True
+                markdown.append(line.rstrip("\n"))
+                continue
+            if line_copy.startswith("END_MaCrOs"):
+                in_a_macro_block = False
+            if not in_a_macro_block:
+                markdown.append(line.rstrip("\n"))
+    for i, line in enumerate(markdown.copy()):
+        for k, v in macros.items():
+            if line.find(k) >= 0:
+                line = line.replace(k, v)
+                markdown[i] = line
+    return markdown
+
+
+def write_document(file_name, n_lines, n_macros):
+    with open(file_name, "w") as f:
+        f.write("MaCrOs\n")
+        for m in range(n_macros):
+            f.write(f"{{'__macro{m}__':'value {m}'}}\n")
+        f.write("END_MaCrOs\n")
+        for n in range(n_lines):
+            f.write(f"Line {n} uses __macro{n % n_macros}__ and __macro{(n * 7) % n_macros}__.\n")
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--macros", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        project = os.path.join(directory, "bench")
+        write_document(project + ".md", args.lines, args.macros)
+
+        def single_pass():
+            ppm2w = PreprocessMarkdown2docx(project)
+            return ppm2w.do_substitute_tokens(ppm2w.get_all_but_macros())
+
+        macros = PreprocessMarkdown2docx(project).macros
+        legacy_time, legacy = best_of(
+            args.repeat, lambda: legacy_preprocess(project + ".md", macros)
+        )
+        new_time, new = best_of(args.repeat, single_pass)
+    assert legacy == new, "single pass output differs from the legacy path"
+    print(f"{args.lines} lines, {args.macros} macros")
+    print(f"legacy      {legacy_time * 1000:9.1f} ms")
+    print(f"single pass {new_time * 1000:9.1f} ms  ({legacy_time / new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
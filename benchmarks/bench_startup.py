@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Measure how long the modules take to import, with python -X importtime, and
+fail if one is over its target or loads the docx stack too early.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --target Markdown2docx=40
+
+Each module is imported in a fresh interpreter --repeat times and the fastest
+run is kept. Only the imports the module causes count, not those of the
+interpreter's own start up. Importing a module must not load docx, bs4,
+markdown2, PIL or lxml: they are loaded when a document is first rendered,
+so markdown2docx-preprocess and the argument parsing of every command stay
+fast. The exit status is 1 when a module is over its target (in milliseconds)
+or loads one of them.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+TARGETS = {  # milliseconds
+    "PreprocessMarkdown2docx": 50,
+    "Markdown2docx": 60,
+    "BatchMarkdown2docx": 80,
+}
+HEAVY = ("docx", "bs4", "markdown2", "PIL", "lxml")
+
+
+def import_times(statement):
+    """module -> (self, cumulative) microseconds for every import statement
+    causes, in the order they start, as -X importtime reports them."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        env=dict(os.environ, PYTHONPATH=SRC),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        if own.strip().isdigit():  # not the header
+            times[name[1:].rstrip()] = int(own), int(cumulative)  # nested names are indented
+    return times
+
+
+def startup(module, repeat):
+    """The fastest import of module in milliseconds, what module imports itself
+    as (name, microseconds), slowest first, and every module it loads."""
+    interpreter = set(import_times("pass"))
+    best = None
+    for _ in range(repeat):
+        times = {name: t for name, t in import_times(f"import {module}").items()
+                 if name.strip() not in interpreter}
+        # top level entries are not indented, and their cumulative times add up
+        total = sum(t[1] for name, t in times.items() if not name.startswith(" ")) / 1000
+        if best is None or total < best[0]:
+            best = total, times
+    total, times = best
+    direct = [(name.strip(), t[1]) for name, t in times.items()
+              if name.startswith("  ") and not name.startswith("    ")]
+    return total, sorted(direct, key=lambda item: -item[1]), {name.strip() for name in times}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--target",
+        action="append",
+        default=[],
+        metavar="MODULE=MS",
+        help="change the target of a module, or add one",
+    )
+    args = parser.parse_args(argv)
+    targets = dict(TARGETS)
+    for target in args.target:
+        module, _, milliseconds = target.partition("=")
+        targets[module] = float(milliseconds)
+
+    import_times("import " + ", ".join(targets))  # write the .pyc files first
+    failures = []
+    print(f"{'module':<28} {'ms':>8} {'target':>8}  slowest imports")
+    for module, target in targets.items():
+        total, direct, loaded = startup(module, args.repeat)
+        slowest = ", ".join(f"{name} {us / 1000:.1f}" for name, us in direct[:3])
+        print(f"{module:<28} {total:8.1f} {target:8.0f}  {slowest}")
+        if total > target:
+            failures.append(f"{module} took {total:.1f}ms to import, the target is {target:.0f}ms")
+        heavy = sorted(name for name in loaded if name.split(".")[0] in HEAVY)
+        if heavy:
+            roots = sorted({name.split(".")[0] for name in heavy})
+            failures.append(f"{module} imports {', '.join(roots)} at start up")
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Time drawing a table cell by cell (do_table) against building the whole
+w:tbl in one pass (do_table_bulk).
+
+    python benchmarks/bench_tables.py --cells 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from Markdown2docx import Markdown2docx, base_document, do_table, do_table_bulk  # noqa: E402
+
+
+def table_html(n_cells, n_cols):
+    n_rows = max(1, n_cells // n_cols - 1)
+    header = "".join(f"<th>Column {c}</th>" for c in range(n_cols))
+    body = "".join(
+        "<tr>" + "".join(f"<td>r{r}c{c}</td>" for c in range(n_cols)) + "</tr>"
+        for r in range(n_rows)
+    )
+    return f"<table><thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>"
+
+
+def time_table(function, table_in):
+    doc = base_document()
+    started = time.perf_counter()
+    function(doc, table_in, Markdown2docx.theme.style_table)
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cells", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--cols", type=int, default=10)
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=10000,
+        help="skip do_table above this many cells, it grows quadratically",
+    )
+    args = parser.parse_args(argv)
+    print(f"{'cells':>8} {'do_table':>12} {'bulk':>12}")
+    for n_cells in args.cells:
+        table_in = BeautifulSoup(table_html(n_cells, args.cols), "html.parser").table
+        legacy = "skipped"
+        if n_cells <= args.legacy_max:
+            legacy = f"{time_table(do_table, table_in) * 1000:10.1f}ms"
+        bulk = time_table(do_table_bulk, table_in)
+        print(f"{n_cells:>8} {legacy:>12} {bulk * 1000:10.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
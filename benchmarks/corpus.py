@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Write a synthetic markdown document, with its pictures and a stub command,
+at a chosen scale.
+
+    python benchmarks/corpus.py /tmp/corpus --scale medium --tables 50 --rows 40
+
+The document has a MaCrOs block whose macros refer to each other, headings,
+paragraphs using the macros, fenced code, tables, nested lists, pictures and
+${commands} that run a local stub executable, so no part of the conversion is
+left out. The same arguments always give the same document.
+"""
+import argparse
+import os
+import random
+import stat
+import sys
+
+from PIL import Image
+
+SCALES = {
+    "small": dict(
+        headings=20, paragraphs=100, code_blocks=10, tables=5, rows=10, cols=4,
+        lists=10, list_depth=3, images=3, macros=20, commands=5,
+    ),
+    "medium": dict(
+        headings=200, paragraphs=1000, code_blocks=100, tables=40, rows=20, cols=5,
+        lists=100, list_depth=3, images=10, macros=200, commands=20,
+    ),
+    "large": dict(
+        headings=1000, paragraphs=5000, code_blocks=500, tables=100, rows=50, cols=6,
+        lists=500, list_depth=3, images=20, macros=1000, commands=50,
+    ),
+}
+
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while markdown becomes a word "
+    "document with tables lists pictures and code for every reader"
+).split()
+
+STUB = """#!/bin/sh
+# stands in for a real ${command}: prints its arguments
+echo "output of $*"
+"""
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _blocks(rng, scale):
+    """The markdown body as a list of blocks, in a repeatable order."""
+    macros = scale["macros"]
+    kinds = (
+        ["heading"] * scale["headings"]
+        + ["paragraph"] * scale["paragraphs"]
+        + ["code"] * scale["code_blocks"]
+        + ["table"] * scale["tables"]
+        + ["list"] * scale["lists"]
+        + ["image"] * scale["images"]
+    )
+    rng.shuffle(kinds)
+    blocks = ["# Benchmark corpus", "Table of contents", "Table of contents"]
+    command = 0
+    for n, kind in enumerate(kinds):
+        if kind == "heading":
+            blocks.append(f"{'#' * rng.randint(2, 4)} Section {n}")
+        elif kind == "paragraph":
+            text = _sentence(rng, rng.randint(8, 40))
+            if macros:
+                text += f" Written by __M{rng.randrange(macros)}__."
+            if scale["commands"] and n % 7 == 0:
+                text += f" ${{./stub {command % scale['commands']}}}"
+                command += 1
+            if n % 5 == 0:
+                text = f"**{text}**"
+            blocks.append(text)
+        elif kind == "code":
+            lines = [f"line_{i} = {rng.randint(0, 999)}" for i in range(rng.randint(3, 15))]
+            blocks.append("```\n" + "\n".join(lines) + "\n```")
+        elif kind == "table":
+            cols = scale["cols"]
+            rows = [
+                "| " + " | ".join(f"Column {c}" for c in range(cols)) + " |",
+                "|" + "---|" * cols,
+            ]
+            for r in range(scale["rows"]):
+                cells = (f"r{r}c{c} {rng.choice(WORDS)}" for c in range(cols))
+                rows.append("| " + " | ".join(cells) + " |")
+            blocks.append("\n".join(rows))
+        elif kind == "list":
+            items = []
+            for i in range(rng.randint(3, 10)):
+                depth = min(rng.randrange(scale["list_depth"]), len(items) and items[-1][0] + 1)
+                items.append((depth, _sentence(rng, 6)))
+            marker = "1." if n % 2 else "*"
+            blocks.append("\n".join(f"{'    ' * d}{marker} {text}" for d, text in items))
+        else:
+            blocks.append(f"![picture](picture{n % max(1, scale['images'])}.png)")
+    return blocks
+
+
+def write_corpus(directory, name="corpus", seed=1, **scale):
+    """Write directory/name.md, its pictures and the ./stub command, and return
+    the project name (directory/name) for PreprocessMarkdown2docx."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for i in range(scale["images"]):
+        size = 200 + 150 * (i % 8), 150 + 100 * (i % 5)
+        Image.new("RGB", size, (i * 9 % 255, 120, 200)).save(
+            os.path.join(directory, f"picture{i}.png")
+        )
+    stub = os.path.join(directory, "stub")
+    with open(stub, "w", encoding="utf8") as stub_fd:
+        stub_fd.write(STUB)
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    macro_lines = []
+    for m in range(scale["macros"]):
+        # every fourth macro refers to the one before it
+        value = f"author {m} of __M{m - 1}__" if m % 4 == 3 else f"author {m}"
+        macro_lines.append(f"{{'__M{m}__': '{value}'}}")
+    project = os.path.join(directory, name)
+    with open(project + ".md", "w", encoding="utf8") as md_fd:
+        md_fd.write("<!--\nMaCrOs\n" + "\n".join(macro_lines) + "\nEND_MaCrOs\n-->\n")
+        md_fd.write("\n\n".join(_blocks(rng, scale)) + "\n")
+    return project
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--name", default="corpus")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    for option in SCALES["small"]:
+        parser.add_argument("--" + option.replace("_", "-"), type=int)
+    args = parser.parse_args(argv)
+    scale = dict(SCALES[args.scale])
+    scale.update({k: v for k, v in vars(args).items() if k in scale and v is not None})
+    print(write_corpus(args.directory, args.name, args.seed, **scale) + ".md")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
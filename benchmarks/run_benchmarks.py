@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Time every stage of a conversion on a synthetic corpus, record wall time and
+peak memory to JSON, and fail if a stage got slower or bigger than a baseline.
+
+    python benchmarks/run_benchmarks.py --scale medium --output results.json
+    python benchmarks/run_benchmarks.py --scale medium --save-baseline baseline.json
+    python benchmarks/run_benchmarks.py --scale medium --baseline baseline.json
+
+No baseline is kept in the repository: timings only compare on one machine,
+so record a baseline before a change and compare against it after.
+
+The stages are PreprocessMarkdown2docx (macros and ${commands}),
+markdown2.markdown, BeautifulSoup parsing, _eat_soup and save. Each stage is
+timed --repeat times and the fastest run is kept; peak memory comes from a
+separate run under tracemalloc, which would otherwise slow the timings down.
+tracemalloc sees Python allocations only, not the XML trees lxml keeps in C.
+A stage fails the gate when it is more than --threshold (a fraction) over the
+baseline, and also more than --min-seconds or --min-bytes over, so that noise
+in very short stages does not fail the run. The exit status is 1 on failure.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import markdown2  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+from corpus import SCALES, write_corpus  # noqa: E402
+from Markdown2docx import Markdown2docx, _eat_soup, markdown_extras  # noqa: E402
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx  # noqa: E402
+
+STAGES = ["preprocess", "markdown2", "soup", "eat_soup", "save"]
+
+
+def run_stages(project, measure):
+    """Run one conversion of project, calling measure(stage, function) for each
+    stage; measure runs function() and returns its result."""
+    directory = os.path.dirname(project)
+
+    def preprocess():
+        ppm2w = PreprocessMarkdown2docx(project, cwd=directory)
+        markdown = ppm2w.get_all_but_macros()
+        markdown = ppm2w.do_substitute_tokens(markdown)
+        return "\n".join(ppm2w.do_execute_commands(markdown))
+
+    markdown = measure("preprocess", preprocess)
+    html = measure("markdown2", lambda: markdown2.markdown(markdown, extras=markdown_extras))
+    soup = measure("soup", lambda: BeautifulSoup(html, "html.parser"))
+    stream = io.BytesIO()
+    # streaming=True only stops the constructor from parsing the markdown again
+    converter = Markdown2docx(project, file_stream=stream, streaming=True, base_dir=directory)
+    measure(
+        "eat_soup",
+        lambda: _eat_soup(
+            soup,
+            converter.doc,
+            converter.page_width_inches,
+            converter.style_quote_table,
+            converter.style_body,
+            converter.style_table,
+            converter.heading_style,
+            converter.style_blockquote,
+            converter.style_strong_text,
+            table_of_contents_string=converter.toc_indicator,
+            base_dir=directory,
+        ),
+    )
+    measure("save", converter.save)
+    return len(stream.getvalue())
+
+
+def time_stages(project, repeat):
+    seconds = {stage: float("inf") for stage in STAGES}
+
+    def measure(stage, function):
+        started = time.perf_counter()
+        result = function()
+        seconds[stage] = min(seconds[stage], time.perf_counter() - started)
+        return result
+
+    for _ in range(repeat):
+        output_bytes = run_stages(project, measure)
+    return seconds, output_bytes
+
+
+def peak_memory(project):
+    """Peak bytes allocated by each stage, over what was live before it."""
+    peaks = {}
+
+    def measure(stage, function):
+        live, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = function()
+        peaks[stage] = tracemalloc.get_traced_memory()[1] - live
+        return result
+
+    tracemalloc.start()
+    try:
+        run_stages(project, measure)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def compare(results, baseline, threshold, min_seconds, min_bytes):
+    """Messages for every stage that regressed against baseline."""
+    failures = []
+    for stage in STAGES:
+        old = baseline["stages"].get(stage)
+        if old is None:
+            continue
+        new = results["stages"][stage]
+        for metric, slack, unit in (("seconds", min_seconds, "s"), ("peak_bytes", min_bytes, "B")):
+            limit = max(old[metric] * (1 + threshold), old[metric] + slack)
+            if new[metric] > limit:
+                failures.append(
+                    f"{stage} {metric}: {new[metric]:.4g}{unit} against "
+                    f"{old[metric]:.4g}{unit} in the baseline (limit {limit:.4g}{unit})"
+                )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--save-baseline", help="write the results here as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--min-seconds", type=float, default=0.005)
+    parser.add_argument("--min-bytes", type=int, default=1 << 20)
+    args = parser.parse_args(argv)
+    if args.baseline and not os.path.exists(args.baseline):
+        print(
+            f"no baseline {args.baseline}; record one on this machine first with\n"
+            f"    python benchmarks/run_benchmarks.py --scale {args.scale} "
+            f"--save-baseline {args.baseline}",
+            file=sys.stderr,
+        )
+        return 2
+
+    with tempfile.TemporaryDirectory() as directory:
+        scale = SCALES[args.scale]
+        project = write_corpus(directory, seed=args.seed, **scale)
+        seconds, output_bytes = time_stages(project, args.repeat)
+        peaks = peak_memory(project)
+    results = {
+        "scale": args.scale,
+        "corpus": scale,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "output_bytes": output_bytes,
+        "stages": {
+            stage: {"seconds": seconds[stage], "peak_bytes": peaks[stage]} for stage in STAGES
+        },
+    }
+    print(f"{'stage':<12} {'seconds':>10} {'peak MB':>10}")
+    for stage in STAGES:
+        stats = results["stages"][stage]
+        print(f"{stage:<12} {stats['seconds']:10.4f} {stats['peak_bytes'] / 1e6:10.2f}")
+    for file_name in (args.output, args.save_baseline):
+        if file_name:
+            with open(file_name, "w", encoding="utf8") as json_fd:
+                json.dump(results, json_fd, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r", encoding="utf8") as json_fd:
+        baseline = json.load(json_fd)
+    if baseline.get("scale") != args.scale or baseline.get("seed") != args.seed:
+        print("the baseline was recorded with another corpus", file=sys.stderr)
+        return 1
+    failures = compare(results, baseline, args.threshold, args.min_seconds, args.min_bytes)
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    print("no regressions" if not failures else f"{len(failures)} regressions")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Convert the same documents one after another and on a pool of threads, and
+fail unless every conversion gives the same .docx, part for part.
+
+    python benchmarks/stress_threads.py --documents 24 --threads 16 --rounds 3
+
+The documents mix numbered and bulleted lists, tables, code, quotes, pictures,
+a table of contents, macros and a ${command}, and are converted with each
+engine, so state leaking from one conversion into another shows up as a
+difference. The sequential run is done in both orders for the same reason.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PIL import Image  # noqa: E402
+
+from Markdown2docx import Markdown2docx  # noqa: E402
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx  # noqa: E402
+
+VARIANTS = [
+    {},
+    {"engine": "direct"},
+    {"streaming": True},
+    {"bulk_tables": True},
+]
+
+
+def document_text(n):
+    """Markdown for document n. Odd documents start with a numbered list and
+    end with bullets, even ones the other way round."""
+    numbered = "\n".join(f"{i}. step {i} of __NAME__" for i in range(1, 4))
+    bullets = "* apple\n* pear\n    * conference\n* plum"
+    first, last = (numbered, bullets) if n % 2 else (bullets, numbered)
+    rows = "\n".join(f"| {r} | row {r} of {n} | ${{echo cell{r}}} |" for r in range(n % 7 + 2))
+    return f"""<!--
+MaCrOs
+{{'__NAME__': 'document {n}'}}
+{{'__TITLE__': 'Stress __NAME__'}}
+END_MaCrOs
+-->
+# __TITLE__
+
+Table of contents
+
+{first}
+
+Some **bold** text and some *emphasis* in __NAME__.
+
+## Data
+
+| Key | Value | Echo |
+|-----|-------|------|
+{rows}
+
+```
+code block {n}
+    indented
+```
+
+> quoted from __NAME__
+
+![picture](picture{n % 3}.png)
+
+---
+
+{last}
+"""
+
+
+def write_documents(directory, count):
+    for i in range(3):
+        Image.new("RGB", (300 + 700 * i, 200 + 300 * i), (40 * i, 90, 160)).save(
+            os.path.join(directory, f"picture{i}.png")
+        )
+    projects = []
+    for n in range(count):
+        project = os.path.join(directory, f"doc{n}")
+        with open(project + ".md", "w", encoding="utf8") as md_fd:
+            md_fd.write(document_text(n))
+        projects.append(project)
+    return projects
+
+
+def convert(job):
+    """Preprocess and convert one (project, variant) job in memory, returning
+    the docx package as {part name: bytes}."""
+    project, variant = job
+    directory = os.path.dirname(project)
+    ppm2w = PreprocessMarkdown2docx(project, cwd=directory)
+    markdown = ppm2w.get_all_but_macros()
+    markdown = ppm2w.do_substitute_tokens(markdown)
+    markdown = ppm2w.do_execute_commands(markdown)
+    stream = io.BytesIO()
+    converter = Markdown2docx(
+        project,
+        "\n".join(markdown),
+        file_stream=stream,
+        base_dir=directory,
+        **VARIANTS[variant],
+    )
+    converter.eat_soup()
+    converter.save()
+    with zipfile.ZipFile(io.BytesIO(stream.getvalue())) as package:
+        return {name: package.read(name) for name in package.namelist()}
+
+
+def differences(expected, got):
+    if list(expected) != list(got):
+        return ["part names differ"]
+    return [name for name in expected if expected[name] != got[name]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        projects = write_documents(directory, args.documents)
+        jobs = [(project, v) for project in projects for v in range(len(VARIANTS))]
+
+        started = time.perf_counter()
+        expected = {job: convert(job) for job in jobs}
+        sequential = time.perf_counter() - started
+        failures = 0
+        for job in reversed(jobs):
+            for name in differences(expected[job], convert(job)):
+                failures += 1
+                print(f"order dependent: {job} {name}", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for round_number in range(args.rounds):
+                started = time.perf_counter()
+                results = list(executor.map(convert, jobs))
+                threaded = time.perf_counter() - started
+                for job, got in zip(jobs, results):
+                    for name in differences(expected[job], got):
+                        failures += 1
+                        print(f"round {round_number}: {job} {name}", file=sys.stderr)
+                print(
+                    f"round {round_number}: {len(jobs)} conversions, "
+                    f"sequential {sequential:.2f}s, {args.threads} threads {threaded:.2f}s"
+                )
+    print("identical" if not failures else f"{failures} differences")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
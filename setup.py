@@ -12,8 +12,33 @@ setup(
     author="Jeremy Lee",
     author_email="jlee2.71818@gmail.com",
     license="MIT",
-    py_modules=["Markdown2docx", "PreprocessMarkdown2docx"],
+    py_modules=[
+        "Markdown2docx",
+        "PreprocessMarkdown2docx",
+        "BatchMarkdown2docx",
+        "CommandCache",
+        "ImagePipeline",
+        "DirectMarkdown2docx",
+        "IncrementalMarkdown2docx",
+        "Metrics",
+        "ServerMarkdown2docx",
+        "PackageWriter",
+        "MergeMarkdown2docx",
+        "AsyncMarkdown2docx",
+        "OutputCache",
+        "ParallelMarkdown2docx",
+        "TableOfContents",
+    ],
     package_dir={"": "src"},
+    entry_points={
+        "console_scripts": [
+            "markdown2docx-batch=BatchMarkdown2docx:main",
+            "markdown2docx-watch=IncrementalMarkdown2docx:main",
+            "markdown2docx-server=ServerMarkdown2docx:main",
+            "markdown2docx-preprocess=PreprocessMarkdown2docx:main",
+            "markdown2docx-merge=MergeMarkdown2docx:main",
+        ],
+    },
     install_requires=[
         "bs4>=0.0.1",
         "pillow",
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import asyncio
+import io
+import os
+
+"""
+    Convert markdown to docx from an asyncio event loop without blocking it.
+
+        converter = AsyncConverter(executor="process", max_concurrent=200)
+        async with converter:
+            docx_bytes = await converter.convert(markdown, macros={"__A__": "1"})
+
+    The macros are expanded on the event loop, which is quick, and ${commands}
+    run as asyncio subprocesses. Parsing, rendering and saving the document are
+    CPU bound and run on an executor: a pool of threads, a pool of processes
+    started once and warmed with the base document (see base_document()), or
+    any concurrent.futures.Executor passed in. Threads share the event loop's
+    interpreter, so only processes render on more than one CPU at a time.
+
+    At most max_concurrent conversions are under way at once; the others wait
+    their turn without holding anything but their markdown, so one loop can
+    keep hundreds of requests in flight. Cancelling a conversion kills its
+    running commands. A conversion already rendering on the executor runs to
+    the end and its result is dropped.
+"""
+
+
+def _render(project, markdown, resolve_image, options):
+    """Parse, render and save preprocessed markdown on an executor. A module
+    function so that a process pool can run it."""
+    from Markdown2docx import render_docx
+
+    output = io.BytesIO()
+    render_docx(project, markdown, output, resolve_image, **options)
+    return output.getvalue()
+
+
+def _warm_worker(template, theme):
+    """Runs once in each worker process as it starts."""
+    from Markdown2docx import base_document
+
+    base_document(template, theme)
+
+
+def _started():
+    """Submitted once per worker to have the pool start them."""
+
+
+class AsyncConverter:
+    """Run conversions for an asyncio event loop. executor is "thread",
+    "process" or a concurrent.futures.Executor, which is then used as it is and
+    not shut down by close(). workers sizes a pool made here (all the CPUs if
+    None). options are Markdown2docx options, such as template, engine or
+    theme, used by every conversion unless convert() is given others. With a
+    process pool the options and resolve_image must pickle, e.g. a dict's get,
+    and a metrics sink is not told about the rendering."""
+
+    def __init__(self, executor="thread", workers=None, max_concurrent=100, **options):
+        if executor not in ("thread", "process") and not hasattr(executor, "submit"):
+            raise ValueError(f"not 'thread', 'process' or an Executor: {executor!r}")
+        self.workers = workers or os.cpu_count() or 1
+        self.max_concurrent = max_concurrent
+        self.options = options
+        self._kind = executor if isinstance(executor, str) else None
+        self._executor = None if isinstance(executor, str) else executor
+        self._slots = None  # made on the event loop that first uses it
+        self.in_flight = 0  # conversions holding a slot
+
+    def _pool(self):
+        if self._executor is None:
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+            if self._kind == "thread":
+                self._executor = ThreadPoolExecutor(self.workers, "markdown2docx")
+            else:
+                import multiprocessing
+
+                # forking a process that runs an event loop and threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_worker,
+                    initargs=(self.options.get("template"), self.options.get("theme")),
+                )
+        return self._executor
+
+    async def convert(
+        self,
+        markdown,
+        macros=None,
+        resolve_image=None,
+        run_commands=False,
+        cwd=None,
+        encoding="utf8",
+        project="document",
+        **options,
+    ):
+        """Markdown2docx.convert() as a coroutine, returning the docx bytes.
+        Raises MacroError, CommandError or what rendering raises."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                return await self._convert(
+                    markdown,
+                    macros,
+                    resolve_image,
+                    run_commands,
+                    cwd,
+                    encoding,
+                    project,
+                    {**self.options, **options},
+                )
+            finally:
+                self.in_flight -= 1
+
+    async def _convert(
+        self,
+        markdown,
+        macros,
+        resolve_image,
+        run_commands,
+        cwd,
+        encoding,
+        project,
+        options,
+    ):
+        from Markdown2docx import preprocess
+
+        ppm2w, lines = preprocess(
+            markdown, macros, cwd, encoding, project, options.get("metrics")
+        )
+        if run_commands:
+            lines = await ppm2w.do_execute_commands_async(lines)
+        if self._kind == "process":
+            options.pop("metrics", None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._pool(), _render, project, "\n".join(lines), resolve_image, options
+        )
+
+    def close(self, wait=True):
+        """Shut down a pool made here. Conversions not yet started are cancelled."""
+        if self._kind is None:
+            return
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    async def __aenter__(self):
+        pool = self._pool()
+        if self._kind == "process":
+            # a process pool only starts a worker when it is given work and
+            # none is idle: a task for each starts and warms them now rather
+            # than during the first conversions (threads start quickly)
+            started = [pool.submit(_started) for _ in range(self.workers)]
+            await asyncio.gather(*map(asyncio.wrap_future, started))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+
+from Markdown2docx import Markdown2docx
+from Metrics import RecordingSink, profile_to
+from OutputCache import OutputCache
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx
+
+"""
+    Convert many markdown files in one go. Files are shared out to a pool of
+    worker processes which stay alive for the whole batch, so the interpreter
+    start up and the imports are paid once per worker rather than once per file.
+
+    Every file gets its own result, a failure in one file does not stop the batch.
+"""
+
+
+def collect_markdown_files(patterns=(), manifest=None):
+    """Expand file names and glob patterns, plus the entries of an optional
+    manifest (one path or pattern per line, '#' starts a comment, relative
+    paths are taken from the manifest's directory). Duplicates are dropped."""
+    patterns = list(patterns)
+    if manifest is not None:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r", encoding="utf8") as manifest_fd:
+            for line in manifest_fd:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    patterns.append(os.path.join(base, line))
+    files = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for file_name in matches:
+            if file_name not in seen:
+                seen.add(file_name)
+                files.append(file_name)
+    return files
+
+
+def convert_file(
+    file_name,
+    output_dir=None,
+    streaming=False,
+    metrics=False,
+    profile_dir=None,
+    cache_dir=None,
+    cache_bytes=None,
+    static_toc=False,
+):
+    """Preprocess and convert a single markdown file to docx.
+    Images and ${commands} are resolved relative to the markdown file.
+    Returns a result dict, errors are reported in it rather than raised.
+    With metrics the result also holds the stage timings and counters, and
+    with a profile_dir the conversion is profiled into profile_dir/<name>.prof.
+    With a cache_dir an unchanged file is copied from an OutputCache there,
+    holding at most cache_bytes, and result["cached"] says whether it was.
+    static_toc is passed to Markdown2docx, see TableOfContents."""
+    started = time.perf_counter()
+    source = os.path.abspath(file_name)
+    directory, base = os.path.split(source)
+    project = base[:-3] if base.endswith(".md") else base
+    out_dir = os.path.abspath(output_dir) if output_dir else directory
+    outfile = os.path.join(out_dir, project + ".docx")
+    result = {"file": file_name, "output": None, "ok": False, "error": None, "cached": False}
+    sink = RecordingSink() if metrics else None
+    profiling = contextlib.nullcontext()
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiling = profile_to(os.path.join(profile_dir, project + ".prof"))
+    try:
+        os.makedirs(out_dir, exist_ok=True)
+        with profiling:
+            # no os.chdir(), so convert_file() can also be called from threads
+            ppm2w = PreprocessMarkdown2docx(
+                os.path.join(directory, project), cwd=directory, metrics=sink
+            )
+            markdown = ppm2w.get_all_but_macros()
+            markdown = ppm2w.do_substitute_tokens(markdown)
+            markdown = "\n".join(ppm2w.do_execute_commands(markdown))
+
+            def render(file_stream):
+                converter = Markdown2docx(
+                    os.path.join(directory, project),
+                    markdown,
+                    file_stream=file_stream,
+                    streaming=streaming,
+                    base_dir=directory,
+                    metrics=sink,
+                    static_toc=static_toc,
+                )
+                converter.eat_soup()
+                converter.save()
+
+            if cache_dir is None:
+                render(outfile)
+            else:
+                cache = OutputCache(cache_dir, cache_bytes)
+                key = cache.key(
+                    markdown, base_dir=directory, streaming=streaming, static_toc=static_toc
+                )
+                data, result["cached"] = cache.get_or_render(key, render)
+                with open(outfile, "wb") as output_fd:
+                    output_fd.write(data)
+        result["output"] = outfile
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    if sink is not None:
+        result["metrics"] = sink.report()
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def convert_batch(
+    files,
+    workers=None,
+    output_dir=None,
+    streaming=False,
+    metrics=False,
+    profile_dir=None,
+    cache_dir=None,
+    cache_bytes=None,
+    static_toc=False,
+):
+    """Convert files on a pool of worker processes, yielding one result per
+    file as each finishes. With workers=1 the files are converted in this
+    process."""
+    options = output_dir, streaming, metrics, profile_dir, cache_dir, cache_bytes, static_toc
+    if workers == 1:
+        for file_name in files:
+            yield convert_file(file_name, *options)
+        return
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_file, file_name, *options) for file_name in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a batch of markdown files to docx."
+    )
+    parser.add_argument("files", nargs="*", help="markdown files or glob patterns")
+    parser.add_argument("-m", "--manifest", help="file listing markdown files")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument("-o", "--output-dir", help="write .docx files here")
+    parser.add_argument(
+        "--streaming", action="store_true", help="render block by block"
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="print each file's timings as JSON"
+    )
+    parser.add_argument("--profile", metavar="DIR", help="write a cProfile per file here")
+    parser.add_argument(
+        "--cache", metavar="DIR", help="reuse the .docx of files that have not changed"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=512, metavar="MB", help="size cap of --cache"
+    )
+    parser.add_argument(
+        "--static-toc",
+        choices=["links", "pages"],
+        help="write the table of contents' entries, with estimated page numbers or none",
+    )
+    args = parser.parse_args(argv)
+    files = collect_markdown_files(args.files, args.manifest)
+    if not files:
+        parser.error("no markdown files given")
+    failures = 0
+    cached = 0
+    results = convert_batch(
+        files,
+        args.jobs,
+        args.output_dir,
+        args.streaming,
+        args.metrics,
+        args.profile,
+        args.cache,
+        args.cache_size << 20,
+        args.static_toc,
+    )
+    for result in results:
+        if args.metrics:
+            print(json.dumps({"file": result["file"], **result["metrics"]}))
+        if result["ok"]:
+            cached += result["cached"]
+            how = "cached" if result["cached"] else f"{result['seconds']:.2f}s"
+            print(f"OK {result['file']} -> {result['output']} ({how})")
+        else:
+            failures += 1
+            print(f"ERROR {result['file']}: {result['error']}", file=sys.stderr)
+    print(f"{len(files) - failures} converted, {failures} failed", file=sys.stderr)
+    if args.cache is not None:
+        misses = len(files) - failures - cached
+        print(f"cache {args.cache}: {cached} hits, {misses} misses", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""
+    A persistent cache for the output of ${command} substitutions.
+
+    Entries are keyed on the command string, the working directory, the values
+    of declared environment variables and the size and modification time of
+    declared files. Entries may expire after a TTL, and the least recently used
+    entries are evicted once the cache grows past max_bytes.
+"""
+
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "markdown2docx", "commands.sqlite")
+
+
+def _file_signature(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class CommandCache:
+    max_bytes = 64 * 1024 * 1024
+    default_ttl = None  # seconds, None keeps entries until they are evicted
+
+    def __init__(self, path=None, max_bytes=None, default_ttl=None):
+        self.path = path or default_cache_path()
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if default_ttl is not None:
+            self.default_ttl = default_ttl
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, command TEXT, output TEXT, "
+            "expires REAL, last_used REAL, size INTEGER)"
+        )
+        self._db.commit()
+
+    def key(self, command, cwd=None, env=(), files=()):
+        """Digest of a command and everything declared to affect its output."""
+        cwd = os.path.abspath(cwd or os.getcwd())
+        signature = [
+            command,
+            cwd,
+            {name: os.environ.get(name) for name in env},
+            {
+                file_name: _file_signature(os.path.join(cwd, file_name))
+                for file_name in files
+            },
+        ]
+        return hashlib.sha256(
+            json.dumps(signature, sort_keys=True).encode("utf8")
+        ).hexdigest()
+
+    def get(self, key):
+        """Return the cached output, or None on a miss or an expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT output, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                if row is not None:
+                    self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, command, output, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, command, output, expires, now, len(output.encode("utf8"))),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+import html
+import re
+
+"""
+    Render markdown straight into a docx.Document, without going through
+    markdown2's HTML and a BeautifulSoup tree.
+
+    Each top-level block is tokenized into a small tuple, and the tuple is
+    handed to the same builder functions eat_soup() uses, so both engines write
+    the same document. Blocks that use markdown this tokenizer does not read
+    (raw HTML, setext headings, indented code, wiki tables, reference links,
+    nested emphasis and so on) return None from tokenize_block() and are
+    rendered by the soup engine, one block at a time.
+
+    Tokens:
+        ("heading", level, text)
+        ("paragraph", text, has_strong, has_em)
+        ("image", src, text)  the text of the paragraph the picture is in
+        ("code", text)
+        ("table", column_names, cells)
+        ("list", ordered, items)  items are (level, data) pairs
+        ("quote", text)
+        ("rule",)
+"""
+
+_heading_re = re.compile(r"^(#{1,6})[ \t]*(.+?)[ \t]*(?<!\\)#*$")
+_setext_re = re.compile(r"^(=+|-+)[ \t]*$")
+_rule_re = re.compile(r"^ {0,2}([-*_])( ?\1){2,} *$")
+_list_item_re = re.compile(r"^( *)([*+-]|\d+\.)[ \t]+(.*)$")
+_table_separator_re = re.compile(r"^\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?$")
+_inline_re = re.compile(
+    r"""
+    (?P<code>(?P<ticks>`+)(?P<code_text>.+?)(?P=ticks))
+    |(?P<image>!\[(?P<alt>[^\]\[*`]*)\]\((?P<src>[^)\s]+)\))
+    |(?P<link>\[(?P<link_text>[^\]\[*`\\]+)\]\((?P<href>[^)\s]+)\))
+    |(?P<strong>\*\*(?=\S)(?P<strong_text>[^*`\[\\]+?)(?<=\S)\*\*)
+    |(?P<em>\*(?=\S)(?P<em_text>[^*`\[\\]+?)(?<=\S)\*)
+    |(?P<escape>\\(?P<escaped>[\\`*_{}\[\]()\#+\-.!]))
+    """,
+    re.X,
+)
+_unsafe_text = set("*`[]<\\")
+_entity_re = re.compile(r"&[#\w]")
+
+
+def parse_inline(text):
+    """Split inline markdown into the pieces of text an HTML parser would see
+    between tags. Returns (pieces, kinds) where kinds is the set of inline
+    elements found, or None if the text needs the full markdown parser."""
+    pieces = []
+    kinds = set()
+    plain = []  # text not yet closed off by a tag
+
+    def add_plain(chunk):
+        if _unsafe_text.intersection(chunk) or _entity_re.search(chunk):
+            return False
+        plain.append(chunk)
+        return True
+
+    def close_plain():
+        if plain:
+            pieces.append("".join(plain))
+            plain.clear()
+
+    position = 0
+    for match in _inline_re.finditer(text):
+        if not add_plain(text[position : match.start()]):
+            return None
+        position = match.end()
+        for kind in ("code", "image", "link", "strong", "em", "escape"):
+            if match.group(kind) is not None:
+                break
+        if kind == "escape":
+            plain.append(match.group("escaped"))
+            continue
+        close_plain()
+        kinds.add(kind)
+        if kind == "code":
+            pieces.append(match.group("code_text").strip())
+        elif kind == "image":
+            kinds.add(("src", match.group("src")))
+        elif kind == "link":
+            pieces.append(match.group("link_text"))
+        else:
+            pieces.append(match.group(kind + "_text"))
+    if not add_plain(text[position:]):
+        return None
+    close_plain()
+    return [html.unescape(piece) for piece in pieces], kinds
+
+
+def _inline_text(text):
+    inline = parse_inline(text)
+    if inline is None:
+        return None
+    pieces, kinds = inline
+    return "".join(pieces), kinds
+
+
+def _tokenize_paragraph(lines):
+    if any(line.endswith("  ") or line[:1].isspace() for line in lines):
+        return None
+    inline = _inline_text("\n".join(lines))
+    if inline is None:
+        return None
+    text, kinds = inline
+    sources = [kind[1] for kind in kinds if isinstance(kind, tuple)]
+    if sources:
+        return ("image", sources[0], text) if "em" not in kinds else None
+    return "paragraph", text.strip(), "strong" in kinds, "em" in kinds
+
+
+def _split_row(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [cell.strip() for cell in line.split("|")]
+
+
+def _cell_text(cell):
+    inline = parse_inline(cell)
+    if inline is None or len(inline[0]) > 1 or inline[1]:
+        return None  # markup in a cell, leave it to the soup engine
+    return inline[0][0] if inline[0] else ""
+
+
+def _tokenize_table(lines):
+    if len(lines) < 2 or "||" in lines[0] or not _table_separator_re.match(lines[1]):
+        return None
+    rows = [_split_row(line) for line in [lines[0]] + lines[2:]]
+    n_cols = len(rows[0])
+    if any(len(row) != n_cols for row in rows) or len(_split_row(lines[1])) != n_cols:
+        return None
+    texts = [_cell_text(cell) for row in rows for cell in row]
+    if None in texts:
+        return None
+    return "table", texts[:n_cols], texts[n_cols:]
+
+
+def _tokenize_list(lines):
+    """Items are indented 4 spaces per level. Every item paragraph is split at
+    its inline tags, as the list parser sees it."""
+    first = _list_item_re.match(lines[0])
+    ordered = first.group(2)[0].isdigit()
+    items = []  # [level, [paragraph lines]]
+    blank = False
+    for line in lines:
+        if not line.strip():
+            blank = True
+            continue
+        if line.endswith("  ") or line.lstrip().startswith((">", "#")):
+            return None  # a line break, or a quote or heading in the item
+        if _rule_re.match(line) or _setext_re.match(line.strip()):
+            return None  # a rule, or the list is a setext heading
+        if _table_separator_re.match(line.strip()):
+            return None  # a table in the item
+        match = _list_item_re.match(line)
+        if match is not None:
+            indent = len(match.group(1))
+            if indent % 4 or (indent and not items):
+                return None
+            level = indent // 4
+            if items and level > items[-1][0] + 1:
+                return None
+            if level == 0 and match.group(2)[0].isdigit() != ordered:
+                return None
+            items.append([level, [[match.group(3)]]])
+        elif blank:
+            indent = len(line) - len(line.lstrip(" "))
+            if indent != 4 * (items[-1][0] + 1) - 1 and indent != 4 * (items[-1][0] + 1):
+                return None
+            items[-1][1].append([line.strip()])
+        else:
+            items[-1][1][-1].append(line.strip())
+        blank = False
+    tokens = []
+    for level, paragraphs in items:
+        for paragraph in paragraphs:
+            inline = parse_inline("\n".join(paragraph))
+            if inline is None or "em" in inline[1]:
+                return None
+            for data in inline[0]:
+                data = data.strip()
+                if data:
+                    tokens.append((level, data))
+    return "list", ordered, tokens
+
+
+def _tokenize_quote(lines):
+    text = []
+    for line in lines:
+        if not line.startswith(">"):
+            return None
+        line = line[1:]
+        text.append(line[1:] if line.startswith(" ") else line)
+    if any(not line.strip() or line.startswith((">", "#", "*", "-", "```")) for line in text):
+        return None
+    inline = _inline_text("\n  ".join(text))
+    if inline is None or "em" in inline[1] or any(isinstance(k, tuple) for k in inline[1]):
+        return None
+    return "quote", inline[0].strip()
+
+
+def tokenize_block(block):
+    """Tokenize one top-level block from split_markdown_blocks(). Returns a
+    token tuple, or None when the block has to go through markdown2."""
+    if "\t" in block:
+        return None  # markdown2 expands tabs to the next multiple of four columns
+    lines = block.rstrip("\n").split("\n")
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if not lines:
+        return None  # the empty document
+    first = lines[0]
+    if any(line.lstrip().startswith("```") for line in lines[1:-1]):
+        return None  # a fence inside a list item or a quote
+    stripped = first.strip()
+    if stripped.startswith("```"):
+        # a language hands the block to pygments
+        if first != "```" or len(lines) < 2 or lines[-1] != "```":
+            return None
+        return "code", "\n".join(lines[1:-1]) + "\n"
+    if first[:1].isspace() or "<" in block:
+        return None
+    if first.startswith("#"):
+        if len(lines) > 1:
+            return None  # underlined, a setext heading
+        match = _heading_re.match(first)
+        inline = match and _inline_text(match.group(2))
+        if not inline or inline[1]:
+            return None
+        return "heading", len(match.group(1)), inline[0]
+    if len(lines) == 1 and _rule_re.match(first):
+        return ("rule",)
+    if first.startswith(">"):
+        return _tokenize_quote(lines)
+    if _list_item_re.match(first):
+        return _tokenize_list(lines)
+    if "|" in first:
+        return _tokenize_table(lines)
+    if any(not line.strip() for line in lines):
+        return None
+    if len(lines) > 1 and _list_item_re.match(lines[1]):
+        return None
+    if any(_setext_re.match(line) or _table_separator_re.match(line) for line in lines[1:]):
+        return None  # the lines above are a heading or the head of a table
+    if any(line.startswith(("#", ">", "[", "```")) or _rule_re.match(line) for line in lines):
+        return None
+    return _tokenize_paragraph(lines)
+
+
+def token_text(token):
+    """The text of the element markdown2 would have made for token, as the
+    soup engine reads it to find the table of contents indicator."""
+    kind = token[0]
+    if kind == "heading":
+        return token[2]
+    if kind in ("paragraph", "code", "quote"):
+        return token[1]
+    if kind == "image":
+        return token[2]
+    if kind == "table":
+        return "\n".join(token[1] + token[2])
+    if kind == "list":
+        return "\n".join(data for _, data in token[2])
+    return ""
+
+
+def token_tag(token):
+    """The HTML tag markdown2 would have made for token."""
+    kind = token[0]
+    if kind == "heading":
+        return f"h{token[1]}"
+    if kind == "list":
+        return "ol" if token[1] else "ul"
+    return {"paragraph": "p", "image": "p", "code": "pre", "table": "table",
+            "quote": "blockquote", "rule": "hr"}[kind]
+
+
+def emit_block(
+    token,
+    doc,
+    page_width_inches,
+    style_quote_table,
+    style_body,
+    style_table,
+    heading_style,
+    style_blockquote,
+    table_of_contents_string="contents",
+    state=None,
+    images=None,
+    bulk_tables=False,
+    base_dir=None,
+    theme=None,
+):
+    """Write one token into doc the way _eat_soup() writes the element markdown2
+    would have made from the same block, including the empty paragraph for the
+    whitespace that follows it."""
+    from Markdown2docx import (
+        add_body_paragraph,
+        add_code_block,
+        add_picture,
+        add_quote,
+        add_styled_paragraph,
+        add_table_bulk,
+        add_table_cells,
+        default_theme,
+        do_fake_horizontal_rule,
+        do_table_of_contents,
+        new_list_parser,
+    )
+
+    if theme is None:
+        theme = default_theme
+    if state is None:
+        state = {"table_of_contents_done": 0}
+    if (
+        token_text(token).lower().find(table_of_contents_string) >= 0
+        and state["table_of_contents_done"] < 2
+    ):
+        state["table_of_contents_done"] += 1
+        if state["table_of_contents_done"] == 2:
+            do_table_of_contents(doc)
+    kind = token[0]
+    if kind == "paragraph":
+        _, text, has_strong, has_em = token
+        if has_em:
+            add_styled_paragraph(doc, text, style_body)
+        else:
+            paragraph = add_body_paragraph(doc, text, theme.style_paragraph)
+            if has_strong:
+                paragraph.runs[0].bold = True
+    elif kind == "heading":
+        _, level, text = token
+        if level <= 4:
+            add_styled_paragraph(doc, text, heading_style)
+    elif kind == "image":
+        add_picture(doc, token[1], page_width_inches, images=images, base_dir=base_dir)
+    elif kind == "code":
+        add_code_block(doc, token[1], style_quote_table, theme.style_code)
+    elif kind == "table":
+        if bulk_tables:
+            n_cols = len(token[1])
+            rows = [token[2][i : i + n_cols] for i in range(0, len(token[2]), n_cols)]
+            add_table_bulk(doc, [token[1]] + rows, style_table)
+        else:
+            add_table_cells(doc, token[1], token[2], style_table)
+    elif kind == "list":
+        parser = new_list_parser(doc, ordered=token[1])
+        for level, data in token[2]:
+            parser.add_item(data, level)
+    elif kind == "quote":
+        add_quote(doc, token[1], style_blockquote)
+    elif kind == "rule":
+        do_fake_horizontal_rule(doc, style_rule=theme.style_rule)
+    add_styled_paragraph(doc, "", style_body)  # the "\n" markdown2 leaves after a block
+    return doc
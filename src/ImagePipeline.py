@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+"""
+    Prepare the pictures of a document before it is rendered.
+
+    Every image file is read at most once. Its size comes from the image header,
+    identical files are found by content hash and processed once, and pictures
+    with more pixels than target_dpi needs at the width they will be shown are
+    downscaled and recompressed on a pool of worker threads (PIL releases the GIL
+    while resizing and encoding). With a cache_dir the processed pictures are kept
+    between builds, and an unchanged file is not even read again.
+
+    One pipeline may be shared by conversions running on several threads.
+"""
+
+
+class ImagePipeline:
+    target_dpi = 200  # pixels per inch wanted in the docx
+    assumed_pixels_per_inch = 200  # as used by do_paragraph to size pictures
+    picture_fraction_of_width = 0.7
+    jpeg_quality = 85
+    downscale_slack = 1.1  # leave pictures alone unless they are this much too big
+
+    def __init__(self, cache_dir=None, target_dpi=None, workers=None, base_dir=None):
+        self.cache_dir = cache_dir
+        if target_dpi is not None:
+            self.target_dpi = target_dpi
+        self.workers = workers
+        self.base_dir = base_dir
+        self._index = {}  # "path|mtime|size" -> {"hash", "size", "format"}
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            try:
+                with open(self._index_file(), "r", encoding="utf8") as index_fd:
+                    self._index = json.load(index_fd)
+            except (OSError, ValueError):
+                self._index = {}
+
+    def _index_file(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _path(self, src):
+        return src if self.base_dir is None else os.path.join(self.base_dir, src)
+
+    def _probe(self, src):
+        """Content hash, pixel size and format of src, plus its bytes if they had to
+        be read. Returns None if the file can not be read."""
+        path = self._path(src)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stat_key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        entry = self._index.get(stat_key)
+        if entry is not None:
+            return entry, None
+        with open(path, "rb") as image_fd:
+            data = image_fd.read()
+        with Image.open(io.BytesIO(data)) as image:  # parses the header only
+            entry = {
+                "hash": hashlib.sha256(data).hexdigest(),
+                "size": list(image.size),
+                "format": image.format,
+            }
+        with self._lock:
+            self._index[stat_key] = entry
+        return entry, data
+
+    def _cached_file(self, entry, width_px):
+        extension = "jpg" if entry["format"] == "JPEG" else "png"
+        return os.path.join(self.cache_dir, f"{entry['hash']}-{width_px}.{extension}")
+
+    def _process(self, src, entry, data, width_px):
+        """Return the picture bytes to embed, downscaled to width_px if it is wider."""
+        cached = None
+        if self.cache_dir is not None:
+            cached = self._cached_file(entry, width_px)
+            if os.path.exists(cached):
+                with open(cached, "rb") as cached_fd:
+                    return cached_fd.read()
+        if data is None:
+            with open(self._path(src), "rb") as image_fd:
+                data = image_fd.read()
+        w, h = entry["size"]
+        if w > width_px * self.downscale_slack:
+            with Image.open(io.BytesIO(data)) as image:
+                height_px = max(1, round(h * width_px / w))
+                image = image.resize((width_px, height_px), Image.LANCZOS)
+                output = io.BytesIO()
+                if entry["format"] == "JPEG":
+                    image.convert("RGB").save(
+                        output, "JPEG", quality=self.jpeg_quality, optimize=True
+                    )
+                else:
+                    image.save(output, "PNG", optimize=True)
+                data = output.getvalue()
+        if cached is not None:
+            # written aside and renamed, so another thread never reads half a file
+            partial = f"{cached}.{os.getpid()}-{threading.get_ident()}"
+            with open(partial, "wb") as cached_fd:
+                cached_fd.write(data)
+            os.replace(partial, cached)
+        return data
+
+    def prepare(self, sources, page_width_inches):
+        """Prepare the pictures named in sources. Returns a dict of
+        src -> (picture bytes, width in inches, height in inches). The sizes come
+        from the original picture, so downscaling never changes the layout.
+        Sources that can not be read are left out, so rendering reports them
+        as before."""
+        sources = list(dict.fromkeys(sources))
+        max_width_inches = page_width_inches * self.picture_fraction_of_width
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            probes = dict(zip(sources, executor.map(self._probe, sources)))
+            jobs = {}  # (hash, width_px) -> future, so duplicates are processed once
+            sizes = {}
+            for src, probe in probes.items():
+                if probe is None:
+                    continue
+                entry, data = probe
+                w, h = entry["size"]
+                width_inches = min(max_width_inches, w / self.assumed_pixels_per_inch)
+                width_px = max(1, round(width_inches * self.target_dpi))
+                job = entry["hash"], width_px
+                sizes[src] = (width_inches, width_inches * h / w), job
+                if job not in jobs:
+                    jobs[job] = executor.submit(self._process, src, entry, data, width_px)
+            prepared = {
+                src: (jobs[job].result(), *inches) for src, (inches, job) in sizes.items()
+            }
+        if self.cache_dir is not None:
+            with self._lock, open(self._index_file(), "w", encoding="utf8") as index_fd:
+                json.dump(self._index, index_fd)
+        return prepared
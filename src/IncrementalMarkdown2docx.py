@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import hashlib
+import io
+import os
+import sys
+import time
+
+from docx.image.image import Image as DocxImage
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from lxml import etree
+
+from Markdown2docx import (
+    Markdown2docx,
+    image_sources,
+    link_definitions,
+    split_markdown_blocks,
+)
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx
+
+"""
+    Rebuild a document after an edit by rendering only the blocks that changed.
+
+    The preprocessed markdown is split into top-level blocks and each block is
+    keyed on its text, the table of contents progress before it, the files of
+    the pictures it names and the reference link definitions it may use. The
+    body XML a block renders to is kept, with the pictures it uses, and the
+    next build splices it into the new document instead of rendering the block
+    again. The result is the same document a streaming conversion
+    (Markdown2docx(..., streaming=True)) would write.
+
+    watch() polls the .md file, its pictures, the template and the files named
+    by ${command} cache options, and rebuilds whenever one of them changes:
+
+        $ markdown2docx-watch hello
+"""
+
+_relationship_ns = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_embed = qn("r:embed")
+_doc_pr = qn("wp:docPr")
+_style_id = qn("w:styleId")
+
+
+class Fragment:
+    """The body elements one block rendered to, the pictures they embed as
+    rId -> (image bytes, file name), the styles rendering it changed, and the
+    table of contents progress after the block."""
+
+    __slots__ = ("elements", "images", "styles", "state")
+
+    def __init__(self, elements, images, styles, state):
+        self.elements = elements
+        self.images = images
+        self.styles = styles
+        self.state = state
+
+
+def _styles_element(doc):
+    return doc.styles.element
+
+
+def changed_styles(before, styles_element):
+    """Copies of the w:style elements of styles_element that differ from the
+    serialized styles before, as rendering sets fonts on the styles it uses."""
+    old = {
+        style.get(_style_id): etree.tostring(style)
+        for style in etree.fromstring(before).iterchildren(qn("w:style"))
+    }
+    return [
+        copy.deepcopy(style)
+        for style in styles_element.iterchildren(qn("w:style"))
+        if old.get(style.get(_style_id)) != etree.tostring(style)
+    ]
+
+
+def _body_end(body):
+    """The element new blocks are inserted before (the section properties), or
+    None if new blocks go at the end of the body."""
+    return body.sectPr
+
+
+def capture_fragment(doc, previous, state, styles_before=None):
+    """Copy the body elements added to doc after previous (None for the start
+    of the body) into a Fragment. styles_before is the serialized styles from
+    before the block was rendered. Returns None if the elements refer to a part
+    other than a picture, which can not be carried to another document."""
+    body = doc.element.body
+    end = _body_end(body)
+    if previous is None:
+        element = body[0] if len(body) else None
+    else:
+        element = previous.getnext()
+    elements = []
+    images = {}
+    while element is not None and element is not end:
+        for child in element.iter():
+            for name, value in child.attrib.items():
+                if not name.startswith(_relationship_ns):
+                    continue
+                relationship = doc.part.rels[value]
+                if name != _embed or relationship.reltype != RT.IMAGE:
+                    return None
+                part = relationship.target_part
+                images[value] = part.blob, part.image.filename
+        elements.append(copy.deepcopy(element))
+        element = element.getnext()
+    styles = []
+    if styles_before is not None:
+        styles_element = _styles_element(doc)
+        if etree.tostring(styles_element) != styles_before:
+            styles = changed_styles(styles_before, styles_element)
+    return Fragment(elements, images, styles, dict(state))
+
+
+def _relate_image(doc, blob, filename):
+    """Add a picture to doc the way doc.add_picture() does, returning its rId."""
+    image = DocxImage._from_stream(io.BytesIO(blob), blob, filename)
+    image_parts = doc.part.package.image_parts
+    part = image_parts._get_by_sha1(image.sha1) or image_parts._add_image_part(image)
+    return doc.part.relate_to(part, RT.IMAGE)
+
+
+def splice_fragment(doc, fragment):
+    """Append a copy of fragment's elements to the body of doc, relating its
+    pictures to doc and numbering them as doc.add_picture() would have, and
+    making the same changes to its styles."""
+    if fragment.styles:
+        styles_element = _styles_element(doc)
+        current = {
+            style.get(_style_id): style
+            for style in styles_element.iterchildren(qn("w:style"))
+        }
+        for style in fragment.styles:
+            replaced = current.get(style.get(_style_id))
+            if replaced is None:
+                styles_element.append(copy.deepcopy(style))
+            else:
+                replaced.addnext(copy.deepcopy(style))
+                styles_element.remove(replaced)
+    elements = [copy.deepcopy(element) for element in fragment.elements]
+    if fragment.images:
+        r_ids = {
+            old: _relate_image(doc, blob, filename)
+            for old, (blob, filename) in fragment.images.items()
+        }
+        shape_id = doc.part.next_id
+        for element in elements:
+            for child in element.iter():
+                if _embed in child.attrib:
+                    child.set(_embed, r_ids[child.get(_embed)])
+                elif child.tag == _doc_pr:
+                    child.set("id", str(shape_id))
+                    child.set("name", f"Picture {shape_id}")
+                    shape_id += 1
+    body = doc.element.body
+    end = _body_end(body)
+    for element in elements:
+        if end is None:
+            body.append(element)
+        else:
+            end.addprevious(element)
+
+
+def render_portable_fragment(converter, render, state):
+    """Call render(state) to render blocks into converter.doc and return the
+    Fragment of what it added, with the elements and styles serialized so that
+    it can be sent to another process. Raises ValueError if the blocks refer to
+    a part other than a picture."""
+    body = converter.doc.element.body
+    end = _body_end(body)
+    previous = body[-1] if end is None else end.getprevious()  # what the template has
+    styles_before = etree.tostring(_styles_element(converter.doc))
+    render(state)
+    fragment = capture_fragment(converter.doc, previous, state, styles_before)
+    if fragment is None:
+        raise ValueError("it refers to a part other than a picture")
+    fragment.elements = [etree.tostring(element) for element in fragment.elements]
+    fragment.styles = [etree.tostring(style) for style in fragment.styles]
+    return fragment
+
+
+def splice_portable_fragment(doc, fragment):
+    """splice_fragment() for a Fragment from render_portable_fragment()."""
+    fragment.elements = [parse_xml(element) for element in fragment.elements]
+    fragment.styles = [parse_xml(style) for style in fragment.styles]
+    splice_fragment(doc, fragment)
+
+
+class IncrementalMarkdown2docx:
+    """Build project.md into a docx, keeping the rendered blocks so that
+    build() only renders the blocks changed since the previous build.
+    The other arguments, such as a metrics sink, are passed on to
+    PreprocessMarkdown2docx and Markdown2docx."""
+
+    def __init__(
+        self,
+        project,
+        file_stream=None,
+        template=None,
+        engine="soup",
+        image_pipeline=None,
+        bulk_tables=False,
+        command_cache=None,
+        macro_library=None,
+        base_dir=None,
+        metrics=None,
+        static_toc=False,
+    ):
+        self.project = project
+        self.file_stream = file_stream or ".".join([project, "docx"])
+        self.template = template
+        self.engine = engine
+        self.image_pipeline = image_pipeline
+        self.bulk_tables = bulk_tables
+        self.command_cache = command_cache
+        self.macro_library = macro_library
+        self.base_dir = base_dir
+        self.metrics = metrics
+        self.static_toc = static_toc
+        self.handlers = {}
+        self._fragments = {}  # block key -> Fragment, from the last build
+        self._watched = [".".join([project, "md"])]
+        self.stats = {"builds": 0, "blocks": 0, "rendered": 0, "reused": 0, "seconds": 0.0}
+
+    def register_handler(self, tag, handler):
+        """See Markdown2docx.register_handler(). Drops the kept blocks."""
+        self.handlers[tag] = handler
+        self._fragments.clear()
+
+    def _path(self, name):
+        return name if self.base_dir is None else os.path.join(self.base_dir, name)
+
+    def _block_key(self, block, state, definitions=()):
+        digest = hashlib.sha256(block.encode("utf8"))
+        digest.update(f"\0{state['table_of_contents_done']}".encode())
+        if "[" in block:  # a reference link renders as its definition says
+            digest.update("\0".join(["", *definitions]).encode("utf8"))
+        for src in image_sources(block):
+            try:
+                stat = os.stat(self._path(src))
+                signature = f"\0{src}|{stat.st_mtime_ns}|{stat.st_size}"
+            except OSError:
+                signature = f"\0{src}|missing"
+            digest.update(signature.encode("utf8"))
+        return digest.hexdigest()
+
+    def _preprocess(self):
+        ppm2w = PreprocessMarkdown2docx(
+            self.project,
+            command_cache=self.command_cache,
+            macro_library=self.macro_library,
+            cwd=self.base_dir,
+            metrics=self.metrics,
+        )
+        markdown = ppm2w.get_all_but_macros()
+        markdown = ppm2w.do_substitute_tokens(markdown)
+        markdown = ppm2w.do_execute_commands(markdown)
+        files = [f for options in ppm2w.command_options.values() for f in options.get("files", ())]
+        return markdown, files
+
+    def build(self):
+        """Preprocess, render the changed blocks, splice in the rest and save.
+        Returns counts for this build: blocks, rendered, reused and seconds."""
+        started = time.perf_counter()
+        markdown, command_files = self._preprocess()
+        converter = Markdown2docx(
+            self.project,
+            file_stream=self.file_stream,
+            streaming=True,
+            template=self.template,
+            image_pipeline=self.image_pipeline,
+            engine=self.engine,
+            bulk_tables=self.bulk_tables,
+            base_dir=self.base_dir,
+            metrics=self.metrics,
+            static_toc=self.static_toc,
+        )
+        for tag, handler in self.handlers.items():
+            converter.register_handler(tag, handler)
+        converter.link_definitions = link_definitions(markdown)
+        body = converter.doc.element.body
+        state = {"table_of_contents_done": 0}
+        fragments = {}
+        counts = {"blocks": 0, "rendered": 0, "reused": 0}
+        watched = [".".join([self.project, "md"])]
+        for block in split_markdown_blocks(markdown):
+            counts["blocks"] += 1
+            watched.extend(self._path(src) for src in image_sources(block))
+            key = self._block_key(block, state, converter.link_definitions)
+            fragment = fragments.get(key) or self._fragments.get(key)
+            if fragment is not None:
+                splice_fragment(converter.doc, fragment)
+                counts["reused"] += 1
+            else:
+                end = _body_end(body)
+                previous = body[-1] if end is None else end.getprevious()
+                styles_before = etree.tostring(_styles_element(converter.doc))
+                converter.eat_block(block, state)
+                fragment = capture_fragment(converter.doc, previous, state, styles_before)
+                counts["rendered"] += 1
+            if fragment is not None:
+                fragments[key] = fragment
+                state = dict(fragment.state)
+        converter.save()
+        self._fragments = fragments  # blocks no longer in the document are let go
+        if self.template is not None:
+            watched.append(self.template)
+        self._watched = list(dict.fromkeys(watched + [self._path(f) for f in command_files]))
+        counts["seconds"] = time.perf_counter() - started
+        self.stats["builds"] += 1
+        for name, value in counts.items():
+            self.stats[name] += value
+        return counts
+
+    def watched_files(self):
+        """The files the last build depended on."""
+        return list(self._watched)
+
+    def _signature(self):
+        signature = {}
+        for name in self._watched:
+            try:
+                stat = os.stat(name)
+                signature[name] = stat.st_mtime_ns, stat.st_size
+            except OSError:
+                signature[name] = None
+        return signature
+
+    def watch(self, interval=0.5, on_build=None, max_builds=None):
+        """Build, then build again each time a watched file changes, checking
+        every interval seconds. on_build(counts, error) is called after every
+        build; a failed build is reported there and watching goes on.
+        Stops after max_builds builds, or runs until interrupted."""
+        builds = 0
+        signature = None
+        while max_builds is None or builds < max_builds:
+            current = self._signature()
+            if current != signature:
+                counts, error = None, None
+                try:
+                    counts = self.build()
+                except Exception as e:
+                    error = e
+                builds += 1
+                signature = self._signature()  # the build may have found new files
+                if on_build is not None:
+                    on_build(counts, error)
+                continue
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a markdown file to docx, again after every change."
+    )
+    parser.add_argument("project", help="the markdown file, with or without .md")
+    parser.add_argument("-o", "--output", help="the .docx to write")
+    parser.add_argument("--template", help="a .docx to take the styles from")
+    parser.add_argument("--engine", choices=["soup", "direct"], default="soup")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds")
+    parser.add_argument("--once", action="store_true", help="build once and stop")
+    args = parser.parse_args(argv)
+    project = args.project[:-3] if args.project.endswith(".md") else args.project
+    builder = IncrementalMarkdown2docx(
+        project,
+        file_stream=args.output,
+        template=args.template,
+        engine=args.engine,
+        base_dir=os.path.dirname(project) or None,
+    )
+
+    def report(counts, error):
+        if error is not None:
+            print(f"ERROR {type(error).__name__}: {error}", file=sys.stderr)
+        else:
+            print(
+                f"{builder.file_stream}: {counts['rendered']} of {counts['blocks']} "
+                f"blocks rendered in {counts['seconds']:.2f}s",
+                file=sys.stderr,
+            )
+
+    try:
+        builder.watch(args.interval, report, max_builds=1 if args.once else None)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
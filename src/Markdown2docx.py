@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
+import copy
 import errno
-import docx
-from docx.enum.style import WD_STYLE_TYPE
-from docx.shared import Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-import markdown2
-from bs4 import BeautifulSoup
-from PIL import Image
-from docx.oxml.shared import OxmlElement, qn
+import io
+import os
+import re
+import threading
+import warnings
+from html import escape
 from html.parser import HTMLParser
-from PreprocessMarkdown2docx import PreprocessMarkdown2docx
+from Metrics import timed
+
+# docx, markdown2, bs4 and PIL take most of the start up time, so they are
+# imported by the functions that use them, when a document is first rendered.
 
 """
     For docx - see
@@ -35,6 +37,8 @@ from PreprocessMarkdown2docx import PreprocessMarkdown2docx
             print(s.name)
 """
 
+__version__ = "0.3.0"
+
 purpose = """
 Read valid markdown, and write a nice docx document using basic elements:
 * Headings
@@ -45,20 +49,16 @@ Read valid markdown, and write a nice docx document using basic elements:
 * Pictures
 """
 
+markdown_extras = ["fenced-code-blocks", "code-friendly", "wiki-tables", "tables"]
+
+_image_md_re = re.compile(r"!\[[^\]]*\]\(\s*<?([^)\s>]+)")
+_image_html_re = re.compile(r"""<img\b[^>]*\bsrc=["']([^"']+)""", re.I)
+
 
 def _read_in_markdown(file_name, encoding="utf8"):
-    try:
-        with open(file_name, "r", encoding=encoding) as input_fd:
-            return input_fd.read()
-    except FileNotFoundError as e:
-        print(f"ERROR: {e}")
-        exit(errno.ENOENT)
-    except PermissionError as e:
-        print(f"ERROR: {e}")
-        exit(errno.EACCES)
-    except IsADirectoryError as e:
-        print(f"ERROR: {e}")
-        exit(errno.EISDIR)
+    # FileNotFoundError, PermissionError and IsADirectoryError reach the caller
+    with open(file_name, "r", encoding=encoding) as input_fd:
+        return input_fd.read()
 
 
 def write_out_html(file_name, text_html, encoding="utf8"):
@@ -66,6 +66,191 @@ def write_out_html(file_name, text_html, encoding="utf8"):
         output_fd.write(text_html)
 
 
+def _iter_lines(markdown):
+    if isinstance(markdown, str):
+        markdown = markdown.splitlines()
+    for line in markdown:
+        yield line.rstrip("\n")
+
+
+def image_sources(markdown):
+    """The picture file names markdown refers to."""
+    return _image_md_re.findall(markdown) + _image_html_re.findall(markdown)
+
+
+def _is_list_item(line):
+    stripped = line.lstrip()
+    if stripped[:2] in ("* ", "- ", "+ "):
+        return True
+    number, _, rest = stripped.partition(". ")
+    return number.isdigit() and bool(rest)
+
+
+# a reference link definition, "[id]: url" with an optional title, as
+# markdown2 strips it from anywhere outside fenced code before reading blocks
+_link_definition_re = re.compile(
+    r"""^ {0,3}\[.+\]:[ \t]*<?\S+?>?(?:[ \t]+["'(].*["')])?[ \t]*$"""
+)
+
+
+# the lines markdown2 reads as a rule, or as the underline of a setext heading
+_rule_re = re.compile(r"^ {0,3}([-_*]) {0,2}(\1 {0,2}){2,}$")
+_underline_re = re.compile(r"^(=+|-+)[ \t]*$")
+# the start of a raw HTML block, which markdown2 takes up to its end tag
+_html_block_re = re.compile(
+    r"^<(blockquote|body|dd|del|div|dl|dt|fieldset|form|h[1-6]|head|html|iframe"
+    r"|ins|li|math|noscript|ol|p|pre|script|style|table|tfoot|ul|address|article"
+    r"|aside|canvas|figcaption|figure|footer|header|main|nav|section|video)\b"
+)
+# the tags markdown2 also takes as a block when the element ends on one line
+_html_line_re = re.compile(
+    r"^<(blockquote|div|dl|fieldset|form|h[1-6]|iframe|math|noscript|ol|p|pre"
+    r"|script|table|ul|address|article|aside|canvas|figcaption|figure|footer"
+    r"|header|main|nav|section|video)\b.*</\1>[ \t]*$"
+)
+
+
+def _tag_is_closed(tag, line):
+    """Whether line closes every tag element it opens, as markdown2 tells."""
+    opened = len(re.findall(rf"<{tag}(?:.*?)>", line))
+    if opened != line.count(f"</{tag}>"):
+        return False
+    return -1 < line.find(f"<{tag}") < line.find(f"</{tag}")
+
+
+def split_markdown_blocks(markdown, definitions=None):
+    """Yield the top-level blocks of markdown (a str or an iterable of lines)
+    one at a time: headings, paragraphs, fenced code, tables, lists, block
+    quotes and raw HTML. Only the block being assembled is held in memory.
+    An empty document is one empty block, which markdown2 makes an empty
+    paragraph of.
+
+    Reference link definitions are left out of the blocks, as markdown2
+    leaves them out of the HTML, and appended to the list definitions if one
+    is given. Only a fence at the start of a line starts or ends a block; an
+    indented one belongs to the list item it is in."""
+    empty = True
+    for block in _markdown_blocks(markdown, definitions):
+        empty = False
+        yield block
+    if empty:
+        yield "\n"
+
+
+def _markdown_blocks(markdown, definitions):
+    block = []
+    fence = None
+    html_tag = None  # the raw HTML block is open while html_depth > 0
+    html_depth = 0
+    heading = False  # the block is a "#" heading, unless an underline follows
+    blank_seen = False
+    in_list = False
+    in_quote = False  # the block has a quote that is not ended by a blank line
+    after_break = False  # a list can start after a rule, an underline or a heading
+    after_definition = False
+    quote_code = False  # the block is a quote continued by indented code
+    for line in _iter_lines(markdown):
+        stripped = line.strip()
+        if fence is not None:
+            block.append(line)
+            if line.rstrip(" \t") == fence:
+                fence = None
+                yield "\n".join(block) + "\n"
+                block = []
+            continue
+        if html_depth:
+            # blank lines and markdown are part of the HTML block
+            block.append(line)
+            if re.match(rf"</{html_tag}\b", line):
+                html_depth -= 1
+            elif re.match(rf"<{html_tag}\b", line):
+                if not _tag_is_closed(html_tag, line):
+                    html_depth += 1
+            elif html_depth == 1 and line.rstrip(" \t").endswith(f"</{html_tag}>"):
+                html_depth = 0  # markdown2 also ends a block at a closing tag
+            if not html_depth:
+                yield "\n".join(block) + "\n"
+                block = []
+            continue
+        if heading:
+            heading = False
+            if _underline_re.match(line):
+                # markdown2 reads "# Head" underlined as a setext heading
+                yield "\n".join(block + [line]) + "\n"
+                block = []
+                continue
+            yield "\n".join(block) + "\n"
+            block = []
+        if not stripped:
+            if after_definition:
+                continue  # markdown2 takes the blank lines with the definition
+            blank_seen = bool(block)
+            if block:
+                block.append(line)
+            continue
+        if _link_definition_re.match(line):
+            if definitions is not None:
+                definitions.append(line)
+            after_definition = True
+            continue
+        after_definition = False
+        # a heading right below a list or a quote is a line of its last item
+        lazy = block and not blank_seen and (in_list or in_quote)
+        if line.startswith("```") or (line.startswith("#") and not lazy):
+            if block:
+                yield "\n".join(block) + "\n"
+            block, blank_seen, in_list, quote_code = [line], False, False, False
+            in_quote = False
+            if line.startswith("```"):
+                fence = line[: len(line) - len(line.lstrip("`"))]
+            else:
+                heading = True
+            continue
+        if blank_seen and not line[0].isspace():
+            if quote_code:
+                # markdown2 reads the code as a line of the quote, and the
+                # paragraph after it as more lines of the quote
+                quote_code = False
+            elif not (in_list and _is_list_item(line)):
+                yield "\n".join(block) + "\n"
+                block = []
+        elif blank_seen and block[0].startswith(">") and not in_list:
+            quote_code = line.startswith(("    ", "\t"))
+            if not quote_code and not line.lstrip().startswith(">"):
+                yield "\n".join(block) + "\n"  # less indented, after the quote
+                block = []
+        elif blank_seen and not in_list and not line.startswith(("    ", "\t")):
+            # indented less than code, not a line of the paragraph above
+            yield "\n".join(block) + "\n"
+            block = []
+        is_rule = bool(_rule_re.match(line))
+        if not block or after_break:
+            in_list = _is_list_item(line) and not is_rule
+        if not block:
+            in_quote = False
+        in_quote = in_quote or line.lstrip().startswith(">")
+        after_break = is_rule or line.startswith("#") or bool(_underline_re.match(line))
+        block.append(line)
+        blank_seen = False
+        match = _html_block_re.match(line)
+        if match and not _tag_is_closed(match.group(1), line):
+            html_tag, html_depth = match.group(1), 1
+        elif _html_line_re.match(line):
+            yield "\n".join(block) + "\n"  # HTML on a line of its own
+            block = []
+    if block:
+        yield "\n".join(block) + "\n"
+
+
+def link_definitions(markdown):
+    """The reference link definitions of markdown, a str or a list of lines,
+    which every block split from it needs to resolve its links."""
+    definitions = []
+    for _ in split_markdown_blocks(markdown, definitions):
+        pass
+    return definitions
+
+
 def find_page_width(doc):
     return float(doc.sections[0].page_width / 914400)
 
@@ -75,6 +260,8 @@ def do_table_of_contents(document):
     Insert Table of Contents Field. The user will be asked to
     update the field when the docx is opened.
     """
+    from docx.oxml.shared import OxmlElement, qn
+
     paragraph = document.add_paragraph()
     run = paragraph.add_run()
     fld_char = OxmlElement("w:fldChar")  # creates a new element
@@ -103,22 +290,130 @@ def do_table(doc, table_in, style):
     the_header = table_in.find("thead")
     the_column_names = the_header.find_all("th")
     the_data = table_in.find_all("td")
-    n_cols = len(the_column_names)
-    n_rows = int(len(the_data) / n_cols)
-    this_table = doc.add_table(rows=n_rows + 1, cols=n_cols, style=style)
+    add_table_cells(
+        doc,
+        ["" if header.text == "" else header.string for header in the_column_names],
+        ["" if data.text == "" else data.string for data in the_data],
+        style,
+    )
+
+
+def add_table_cells(doc, column_names, cells, style):
+    """Draw a table from the header texts and the texts of the data cells in
+    reading order."""
+    n_cols = len(column_names)
+    n_rows = int(len(cells) / n_cols)
+    this_table = add_styled_table(doc, n_rows + 1, n_cols, style)
     row = this_table.rows[0].cells
-    for h_index, header in enumerate(the_column_names):
-        row[h_index].text = "" if header.text == "" else header.string
+    for h_index, header in enumerate(column_names):
+        row[h_index].text = header
     row_index = 0
-    for d_index, data in enumerate(the_data):
+    for d_index, data in enumerate(cells):
         if not d_index % n_cols:
             row = this_table.rows[row_index + 1].cells
             row_index += 1
-        row[d_index % n_cols].text = "" if data.text == "" else data.string
+        row[d_index % n_cols].text = data
+
+
+def _run_xml(text):
+    """The w:r for text, with tabs and line breaks as python-docx writes them."""
+    parts = []
+    for line_index, line in enumerate(text.split("\n")):
+        if line_index:
+            parts.append("<w:br/>")
+        for tab_index, chunk in enumerate(line.split("\t")):
+            if tab_index:
+                parts.append("<w:tab/>")
+            if chunk:
+                space = ' xml:space="preserve"' if chunk != chunk.strip() else ""
+                parts.append(f"<w:t{space}>{escape(chunk, quote=False)}</w:t>")
+    return "<w:r>" + "".join(parts) + "</w:r>" if parts else ""
+
+
+def add_table_bulk(
+    doc, rows, style, header_rows=1, column_widths=None, repeat_header=True
+):
+    """Draw a table by building its w:tbl element in one pass, in time linear
+    in the number of cells. rows is a list of rows, each a list of cell texts
+    or (text, colspan) pairs; short rows are padded with empty cells. The first
+    header_rows rows repeat at the top of each page when repeat_header is set.
+    column_widths is a list of Lengths, by default the page width is shared
+    evenly."""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    from docx.table import Table
+
+    rows = [
+        [cell if isinstance(cell, tuple) else (cell, 1) for cell in row] for row in rows
+    ]
+    n_cols = max((sum(span for _, span in row) for row in rows), default=0)
+    if not n_cols:
+        return None
+    if column_widths is None:
+        column_widths = [doc._block_width // n_cols] * n_cols
+    twips = [int(width) // 635 for width in column_widths]
+    style_xml = ""
+    table_style = style_id(doc, style, "table")
+    if table_style is not None:
+        style_xml = f'<w:tblStyle w:val="{table_style}"/>'
+    xml = [
+        f"<w:tbl {nsdecls('w')}><w:tblPr>{style_xml}"
+        '<w:tblW w:type="auto" w:w="0"/>'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" '
+        'w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+        "<w:tblGrid>",
+        "".join(f'<w:gridCol w:w="{width}"/>' for width in twips),
+        "</w:tblGrid>",
+    ]
+    for row_index, row in enumerate(rows):
+        xml.append("<w:tr>")
+        if repeat_header and row_index < header_rows:
+            xml.append("<w:trPr><w:tblHeader/></w:trPr>")
+        column = 0
+        for text, span in row + [("", 1)] * (n_cols - sum(s for _, s in row)):
+            span = min(span, n_cols - column)
+            width = sum(twips[column : column + span])
+            grid_span = f'<w:gridSpan w:val="{span}"/>' if span > 1 else ""
+            xml.append(
+                f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/>{grid_span}</w:tcPr>'
+                f"<w:p>{_run_xml(text)}</w:p></w:tc>"
+            )
+            column += span
+        xml.append("</w:tr>")
+    xml.append("</w:tbl>")
+    tbl = parse_xml("".join(xml))
+    doc.element.body._insert_tbl(tbl)
+    return Table(tbl, doc._body)
+
+
+def table_rows(table_in):
+    """The rows of a bs4 table as lists of (text, colspan), and how many of
+    them are header rows."""
+    rows = []
+    header_rows = 0
+    for tr in table_in.find_all("tr"):
+        cells = tr.find_all(["th", "td"], recursive=False)
+        try:
+            rows.append([(c.get_text(), int(c.get("colspan", 1))) for c in cells])
+        except ValueError:
+            rows.append([(c.get_text(), 1) for c in cells])
+        is_header = tr.parent.name == "thead" or all(c.name == "th" for c in cells)
+        if is_header and header_rows == len(rows) - 1:  # leading header rows only
+            header_rows += 1
+    return rows, header_rows
+
+
+def do_table_bulk(doc, table_in, style):
+    """Draw a table with add_table_bulk()."""
+    rows, header_rows = table_rows(table_in)
+    return add_table_bulk(doc, rows, style, header_rows=header_rows)
 
 
 def find_image_size(image_file):
-    return Image.open(image_file).size
+    from PIL import Image
+
+    with Image.open(image_file) as image:
+        return image.size
 
 
 def do_paragraph(
@@ -128,72 +423,542 @@ def do_paragraph(
     style_body,
     assumed_pixels_per_inch=200,
     picture_fraction_of_width=0.7,
+    images=None,
+    base_dir=None,
 ):
     is_image = line.find("img")
     if is_image is not None:
-        image_source = is_image["src"]
-        w, h = find_image_size(image_source)
+        add_picture(
+            doc,
+            is_image["src"],
+            page_width_inches,
+            assumed_pixels_per_inch,
+            picture_fraction_of_width,
+            images,
+            base_dir,
+        )
+        return
+    return add_body_paragraph(doc, line.text.strip(), style_body)
+
+
+def add_picture(
+    doc,
+    image_source,
+    page_width_inches,
+    assumed_pixels_per_inch=200,
+    picture_fraction_of_width=0.7,
+    images=None,
+    base_dir=None,
+):
+    """Add the picture image_source, a path relative to base_dir (the current
+    directory if None) unless images holds it already prepared."""
+    from docx.shared import Inches
+
+    if images and image_source in images:  # from an ImagePipeline or resolve_images()
+        data, chosen_width, chosen_height = images[image_source]
+        doc.add_picture(
+            io.BytesIO(data),
+            width=Inches(chosen_width),
+            height=None if chosen_height is None else Inches(chosen_height),
+        )
+        return
+    if base_dir is not None:
+        image_source = os.path.join(base_dir, image_source)
+    w, h = find_image_size(image_source)
+    w_in_inches = w / assumed_pixels_per_inch
+    picture_width_inches = page_width_inches * picture_fraction_of_width
+    chosen_width = min(picture_width_inches, w_in_inches)
+    doc.add_picture(image_source, width=Inches(chosen_width))
+
+
+def resolve_images(
+    resolver,
+    sources,
+    page_width_inches,
+    assumed_pixels_per_inch=200,
+    picture_fraction_of_width=0.7,
+):
+    """Fetch the pictures named in sources with resolver(src), which returns
+    the picture as bytes or a binary file object, or None if there is no such
+    picture. Returns src -> (bytes, width in inches, None) for add_picture(),
+    sized as add_picture() sizes a picture file. Raises FileNotFoundError for
+    a picture the resolver does not have."""
+    images = {}
+    for src in dict.fromkeys(sources):
+        data = resolver(src)
+        if data is None:
+            raise FileNotFoundError(errno.ENOENT, "No picture", src)
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = data.read()
+        w, h = find_image_size(io.BytesIO(data))
         w_in_inches = w / assumed_pixels_per_inch
         picture_width_inches = page_width_inches * picture_fraction_of_width
-        chosen_width = min(picture_width_inches, w_in_inches)
-        doc.add_picture(image_source, width=docx.shared.Inches(chosen_width))
-        return
-    paragraph = doc.add_paragraph(line.text.strip(), style=style_body)
-    paragraph.style.font.name = "Verdana"
-    paragraph.style.font.size = Pt(11)
-    paragraph_format = paragraph.paragraph_format
-    paragraph_format.space_before = Pt(0)
-    paragraph_format.space_after = Pt(0)
+        images[src] = data, min(picture_width_inches, w_in_inches), None
+    return images
+
+
+def style_id(doc, style, style_type="paragraph"):
+    """The ID python-docx would give a paragraph (or "character" or "table")
+    of style, a style object or name: None for the default style and for no
+    style. Raises KeyError or ValueError as python-docx does. Each style is
+    looked up once per document, and a copy of a base document starts with
+    the styles of its theme looked up already."""
+    if style is None:
+        return None
+    ids = doc.__dict__.setdefault("_style_ids", {})
+    if isinstance(style, str):
+        key = style, style_type
+    else:
+        key = style.style_id, style_type, None
+    try:
+        return ids[key]
+    except KeyError:
+        from docx.enum.style import WD_STYLE_TYPE
+
+        kind = getattr(WD_STYLE_TYPE, style_type.upper())
+        ids[key] = doc.part.get_style_id(style, kind)
+        return ids[key]
+
+
+def add_styled_paragraph(doc, text="", style=None):
+    """doc.add_paragraph(text, style), with the style ID from style_id()."""
+    paragraph = doc.add_paragraph(text)
+    paragraph_style = style_id(doc, style)
+    if paragraph_style is not None:
+        paragraph._p.style = paragraph_style
     return paragraph
 
 
-def do_pre_code(line, doc, style_quote_table):
-    table = doc.add_table(rows=1, cols=1, style=style_quote_table)
+def add_styled_table(doc, rows, cols, style=None):
+    """doc.add_table(rows, cols, style), with the style ID from style_id()."""
+    table = doc.add_table(rows=rows, cols=cols)
+    table._tbl.tblStyle_val = style_id(doc, style, "table")
+    return table
+
+
+def add_body_paragraph(doc, text, style_body):
+    return add_styled_paragraph(doc, text, style_body)
+
+
+def do_pre_code(line, doc, style_quote_table, style_code=None):
+    add_code_block(doc, line.text, style_quote_table, style_code)
+
+
+def add_code_block(doc, text, style_quote_table, style_code=None):
+    """A one cell table holding text in style_code, by default the theme's."""
+    table = add_styled_table(doc, 1, 1, style_quote_table)
     cell = table.cell(0, 0)
-    cell.text = line.text
-    paragraphs = cell.paragraphs
-    paragraph = paragraphs[0]
-    run_obj = paragraph.runs
-    run = run_obj[0]
-    font = run.font
-    font.size = Pt(10)
-    font.name = "Verdana"
+    cell.text = text
+    code_style = style_id(doc, style_code or default_theme.style_code)
+    if code_style is not None:
+        cell.paragraphs[0]._p.style = code_style
 
 
-def do_fake_horizontal_rule(doc, length_of_line=80, c="_"):
-    paragraph = doc.add_paragraph(c * length_of_line)
-    paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+def do_fake_horizontal_rule(doc, length_of_line=80, c="_", style_rule=None):
+    style_rule = style_rule or default_theme.style_rule
+    add_styled_paragraph(doc, c * length_of_line, style_rule)
 
 
 def do_blockquote(line, doc, style_blockquote):
     """Handle block quotes."""
-    paragraph = doc.add_paragraph(line.text.strip(), style=style_blockquote)
-    paragraph.style.font.name = "Verdana"
-    paragraph.style.font.size = Pt(11)
-    paragraph_format = paragraph.paragraph_format
-    paragraph_format.space_before = Pt(6)
-    paragraph_format.space_after = Pt(6)
+    add_quote(doc, line.text.strip(), style_blockquote)
+
+
+def add_quote(doc, text, style_blockquote):
+    return add_styled_paragraph(doc, text, style_blockquote)
 
 
 def do_strong_text(line, doc, style_strong_text):
     """Handle <strong> elements."""
-    paragraph = doc.add_paragraph(line.text.strip(), style=style_strong_text)
-    paragraph.style.font.name = "Verdana"
-    paragraph.style.font.size = Pt(11)
-    paragraph_format = paragraph.paragraph_format
-    paragraph_format.space_before = Pt(3)
-    paragraph_format.space_after = Pt(3)
+    paragraph = add_styled_paragraph(doc, line.text.strip(), style_strong_text)
     run = paragraph.runs[0]
     run.bold = True
 
 
+def _set_style_properties(style, properties):
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.shared import Pt, RGBColor
+
+    font = style.font
+    if "color" in properties:
+        font.color.rgb = RGBColor.from_string(properties["color"])
+    if "size" in properties:
+        font.size = Pt(properties["size"])
+    if "font" in properties:
+        font.name = properties["font"]
+    for name in ("bold", "italic"):
+        if name in properties:
+            setattr(font, name, properties[name])
+    if "alignment" in properties:
+        alignment = getattr(WD_ALIGN_PARAGRAPH, properties["alignment"].upper())
+        style.paragraph_format.alignment = alignment
+    for name in ("space_before", "space_after"):
+        if name in properties:
+            setattr(style.paragraph_format, name, Pt(properties[name]))
+
+
+def define_style(doc, name, properties):
+    """Give the style name the properties of a theme entry (see Theme). A
+    style with a base_style is added if doc does not have it, and left alone
+    if it does; any other style must exist and has the properties set."""
+    from docx.enum.style import WD_STYLE_TYPE
+
+    styles = doc.styles
+    if "base_style" in properties:
+        if name in {style.name for style in styles}:
+            return styles[name]
+        kind = getattr(WD_STYLE_TYPE, properties.get("type", "paragraph").upper())
+        style = styles.add_style(name, kind)
+        style.base_style = styles[properties["base_style"]]
+    else:
+        style = styles[name]
+    _set_style_properties(style, properties)
+    return style
+
+
 def add_style_strong_text(doc):
-    style_strong_text = doc.styles.add_style("Strong Text", WD_STYLE_TYPE.CHARACTER)
-    style_strong_text.base_style = doc.styles["Normal"]
-    style_strong_text.font.color.rgb = RGBColor(0, 0, 0)  # Adjust the color as needed
-    style_strong_text.font.size = Pt(11)
-    style_strong_text.font.bold = True
-    return style_strong_text
+    return define_style(doc, "Strong Text", Theme.styles["Strong Text"])
+
+
+def add_custom_styles(doc, theme=None):
+    """Compile theme (default_theme if None) into the styles of doc."""
+    (default_theme if theme is None else theme).compile(doc)
+
+
+def _paragraph_style(theme, before, style_body):
+    """The style_paragraph of theme once its style_body is style_body: the
+    body style, unless theme writes paragraphs in a style of their own."""
+    if style_body == before.style_body:
+        return theme.style_paragraph
+    if theme.style_paragraph in (Theme.style_paragraph, before.style_body):
+        return style_body
+    return theme.style_paragraph
+
+
+class Theme:
+    """How a converted document looks. A theme is compiled into the styles of
+    the base document once (see base_document()); rendering then refers to
+    the styles by ID and never changes them, so every block costs the same
+    whatever the theme.
+
+    The style_* attributes name the style each kind of block is written in;
+    paragraphs are written in style_body too when only that is changed.
+    styles maps style names to their properties: font, size (points), bold,
+    italic, color ("RRGGBB"), alignment ("center", ...), space_before and
+    space_after (points). An entry with a base_style (and a type, "paragraph"
+    unless "character") is a style of our own, added unless the template has
+    it already; the other entries change a style the template must have.
+
+    Change a theme by subclassing it, or with keywords, where styles are
+    merged into the defaults style by style:
+        Theme(styles={"Body Text": {"font": "Georgia", "size": 10}})
+    """
+
+    style_table = "Medium Shading 1 Accent 3"
+    style_quote = "Body Text"
+    style_body = "Body Text"  # the gaps markdown2 leaves between blocks
+    style_paragraph = "Custom Body"  # "Custom Body" is based on "Body Text"
+    style_quote_table = "Table Grid"
+    style_blockquote = "Custom Quote"
+    style_strong_text = "Strong Text"
+    style_heading = "Custom Heading"
+    style_code = "Custom Code"
+    style_rule = "Custom Rule"
+    styles = {
+        "Custom Heading": {
+            "base_style": "Heading 2",
+            "color": "000000",
+            "size": 18,
+            "font": "Verdana",
+            "space_before": 12,
+            "space_after": 6,
+        },
+        "Custom Quote": {
+            "base_style": "Normal",
+            "size": 11,
+            "font": "Verdana",
+            "italic": True,
+            "space_before": 6,
+            "space_after": 6,
+        },
+        "Strong Text": {
+            "base_style": "Normal",
+            "type": "character",
+            "color": "000000",
+            "size": 11,
+            "font": "Verdana",
+            "bold": True,
+        },
+        "Body Text": {"size": 11, "font": "Verdana"},
+        "Custom Body": {"base_style": "Body Text", "space_before": 0, "space_after": 0},
+        "Custom Code": {"base_style": "Normal", "size": 10, "font": "Verdana"},
+        "Custom Rule": {"base_style": "Normal", "alignment": "center"},
+    }
+
+    def __init__(self, **attributes):
+        for name, value in attributes.items():
+            if not hasattr(type(self), name):
+                raise TypeError(f"{type(self).__name__} has no attribute {name!r}")
+            if name == "styles":
+                value = {
+                    style: {**self.styles.get(style, {}), **properties}
+                    for style, properties in {**self.styles, **value}.items()
+                }
+            setattr(self, name, value)
+        if "style_paragraph" not in attributes:
+            self.style_paragraph = _paragraph_style(self, Theme, self.style_body)
+
+    def key(self):
+        """A hashable value that is the same for themes that look the same."""
+        names = {name for cls in type(self).__mro__ for name in vars(cls)}
+        names = tuple(
+            (name, getattr(self, name))
+            for name in sorted(names)
+            if name.startswith("style_")
+        )
+        styles = tuple(
+            (name, tuple(sorted(properties.items())))
+            for name, properties in self.styles.items()
+        )
+        return names, styles
+
+    def compile(self, doc):
+        """Define the styles of the theme in doc and look up the IDs of every
+        style it names (see style_id())."""
+        for name, properties in self.styles.items():
+            define_style(doc, name, properties)
+        for name in (
+            self.style_body,
+            self.style_paragraph,
+            self.style_blockquote,
+            self.style_heading,
+            self.style_code,
+            self.style_rule,
+            *HtmlListParser.lists,
+            *HtmlListParser.ordered_lists,
+        ):
+            style_id(doc, name)
+        for name in (self.style_table, self.style_quote_table):
+            style_id(doc, name, "table")
+
+
+default_theme = Theme()
+
+_base_documents = {}  # (template, theme key) -> styled docx.Document
+_base_documents_lock = threading.Lock()
+
+
+def _template_key(template):
+    if template is None:
+        return None
+    template = os.path.abspath(template)
+    stat = os.stat(template)
+    return template, stat.st_mtime_ns, stat.st_size
+
+
+def base_document(template=None, theme=None):
+    """Return a fresh copy of the base document for template (None for the
+    python-docx default) styled by theme (default_theme if None). The
+    template is parsed and the theme compiled once per process, after that
+    each call only deep copies the parsed package.
+    Safe to call from several threads at once."""
+    import docx
+
+    theme = default_theme if theme is None else theme
+    key = (_template_key(template), theme.key())
+    with _base_documents_lock:
+        base = _base_documents.get(key)
+        if base is None:
+            base = docx.Document(template)
+            theme.compile(base)
+            _base_documents[key] = base
+        return copy.deepcopy(base)
+
+
+def clear_base_document_cache():
+    with _base_documents_lock:
+        _base_documents.clear()
+
+
+def _handle_heading(renderer, node):
+    # every level is written in the theme's one heading style
+    add_styled_paragraph(renderer.doc, node, renderer.heading_style)
+
+
+def _handle_paragraph(renderer, node):
+    paragraph = do_paragraph(
+        node,
+        renderer.doc,
+        renderer.page_width_inches,
+        renderer.theme.style_paragraph,
+        images=renderer.images,
+        base_dir=renderer.base_dir,
+    )
+    strong_element = node.find("strong")
+    if strong_element:
+        run = paragraph.runs[0]
+        run.bold = True
+
+
+def _handle_list(node, parser, list_level=0):
+    """Feed the text of a ul/ol element to a list parser, level by level,
+    straight from the soup."""
+    from bs4 import NavigableString, Tag
+
+    for child in node.children:
+        if isinstance(child, Tag):
+            _handle_list(child, parser, list_level + (child.name in ("ol", "ul")))
+        elif type(child) is NavigableString:
+            data = child.strip()
+            if data:
+                parser.add_item(data, list_level)
+
+
+default_handlers = {
+    "hr": lambda renderer, node: do_fake_horizontal_rule(
+        renderer.doc, style_rule=renderer.theme.style_rule
+    ),
+    "h1": _handle_heading,
+    "h2": _handle_heading,
+    "h3": _handle_heading,
+    "h4": _handle_heading,
+    "p": _handle_paragraph,
+    "pre": lambda renderer, node: do_pre_code(
+        node, renderer.doc, renderer.style_quote_table, renderer.theme.style_code
+    ),
+    "table": lambda renderer, node: (
+        do_table_bulk if renderer.bulk_tables else do_table
+    )(renderer.doc, node, renderer.style_table),
+    "ul": lambda renderer, node: _handle_list(node, new_list_parser(renderer.doc)),
+    "ol": lambda renderer, node: _handle_list(
+        node, new_list_parser(renderer.doc, ordered=True)
+    ),
+    "blockquote": lambda renderer, node: do_blockquote(
+        node, renderer.doc, renderer.style_blockquote
+    ),
+    "strong": lambda renderer, node: do_strong_text(
+        node, renderer.doc, renderer.style_strong_text
+    ),
+}
+
+
+class SoupRenderer:
+    """Render the top-level nodes of a beautiful soup (bs4) object into a Word
+    docx, dispatching on the tag name. A handler is called as
+    handler(renderer, node) and writes into renderer.doc; the renderer also
+    carries the page width, the styles and the prepared images. Tags without
+    a handler are skipped.
+
+    All the state of a conversion lives on the renderer and its doc, so
+    renderers on different threads do not interfere.
+
+    With a metrics sink every handler call is timed as the stage "tag", and
+    the blocks, table cells and pictures rendered are counted."""
+
+    def __init__(
+        self,
+        doc,
+        page_width_inches,
+        style_quote_table,
+        style_body,
+        style_table,
+        heading_style,
+        style_blockquote,
+        style_strong_text,
+        table_of_contents_string="contents",
+        state=None,
+        images=None,
+        handlers=None,
+        bulk_tables=False,
+        base_dir=None,
+        metrics=None,
+        theme=None,
+    ):
+        self.doc = doc
+        self.page_width_inches = page_width_inches
+        self.style_quote_table = style_quote_table
+        self.style_body = style_body
+        self.style_table = style_table
+        self.heading_style = heading_style
+        self.style_blockquote = style_blockquote
+        self.style_strong_text = style_strong_text
+        self.table_of_contents_string = table_of_contents_string
+        self.state = {"table_of_contents_done": 0} if state is None else state
+        self.images = images
+        self.handlers = dict(default_handlers if handlers is None else handlers)
+        self.bulk_tables = bulk_tables
+        self.base_dir = base_dir  # pictures are found relative to this
+        self.metrics = metrics
+        self.theme = default_theme if theme is None else theme
+
+    def register(self, tag, handler):
+        """Add or replace the handler for tag. None removes it."""
+        if handler is None:
+            self.handlers.pop(tag, None)
+        else:
+            self.handlers[tag] = handler
+
+    def _check_table_of_contents(self, node):
+        if self.state["table_of_contents_done"] >= 2:
+            return
+        if mentions_table_of_contents(node, self.table_of_contents_string):
+            self.state["table_of_contents_done"] += 1
+            if self.state["table_of_contents_done"] == 2:
+                do_table_of_contents(self.doc)
+
+    def render(self, soup):
+        from bs4 import Tag
+
+        handlers = self.handlers
+        for node in soup.children:
+            self._check_table_of_contents(node)
+            if not isinstance(node, Tag):
+                # markdown2 leaves whitespace between the elements
+                if str(node).find("em") != 0:
+                    add_styled_paragraph(self.doc, node.text.strip(), self.style_body)
+                continue
+            if node.find("em"):
+                add_styled_paragraph(self.doc, node.get_text().strip(), self.style_body)
+                continue
+            handler = handlers.get(node.name)
+            if handler is None:
+                continue
+            if self.metrics is None:
+                handler(self, node)
+            else:
+                self._render_measured(handler, node)
+        return self.doc
+
+    def _render_measured(self, handler, node):
+        metrics = self.metrics
+        with timed(metrics, "tag", tag=node.name):
+            handler(self, node)
+        metrics.count("blocks", tag=node.name)
+        if node.name == "table":
+            metrics.count("table_cells", len(node.find_all(["td", "th"])))
+        elif node.name == "p":
+            for image in node.find_all("img", src=True):
+                metrics.count("images")
+                metrics.count("image_bytes", image_bytes(image["src"], self.images, self.base_dir))
+
+
+def mentions_table_of_contents(node, table_of_contents_string="contents"):
+    """Whether a top-level soup node counts towards placing the table of
+    contents, which goes in at the second node that mentions it."""
+    from bs4 import Tag
+
+    text = node.get_text() if isinstance(node, Tag) else str(node)
+    return text.lower().find(table_of_contents_string) >= 0
+
+
+def image_bytes(src, images=None, base_dir=None):
+    """The size of the picture src as it goes into the docx."""
+    if images and src in images:
+        return len(images[src][0])
+    try:
+        return os.path.getsize(src if base_dir is None else os.path.join(base_dir, src))
+    except OSError:
+        return 0
 
 
 def _eat_soup(
@@ -207,87 +972,58 @@ def _eat_soup(
     style_blockquote,
     style_strong_text,
     table_of_contents_string="contents",
+    state=None,
+    images=None,
+    handlers=None,
+    bulk_tables=False,
+    base_dir=None,
+    metrics=None,
+    theme=None,
 ):
     """HTML from markdown has been converted to a beautiful soup (bs4) object.
-    Process the object to render a Word docx."""
-    list_of_tables = soup.find_all("table")
-    table_counter = 0
-    table_of_contents_done = 0
-    for line in soup:
-        if line is not None:
-            if (
-                str(line).lower().find(table_of_contents_string) >= 0
-                and table_of_contents_done < 2
-            ):
-                table_of_contents_done += 1
-                if table_of_contents_done == 2:
-                    do_table_of_contents(doc)
-            if line.find("em"):
-                try:
-                    doc.add_paragraph(line.text.strip(), style=style_body)
-                except AttributeError:
-                    pass
-                continue
-            if str(line).lower().find("<hr/>") == 0:
-                do_fake_horizontal_rule(doc)
-                continue
-            if line.name == "h1":
-                heading = doc.add_heading(line, 0)
-                heading.style = heading_style
-                continue
-            if line.name == "h2":
-                heading = doc.add_heading(line, 1)
-                heading.style = heading_style
-                continue
-            if line.name == "h3":
-                heading = doc.add_heading(line, 2)
-                heading.style = heading_style
-                continue
-            if line.name == "h4":
-                heading = doc.add_heading(line, 3)
-                heading.style = heading_style
-                continue
-            if line.name == "p":
-                paragraph = do_paragraph(line, doc, page_width_inches, style_body)
-                strong_element = line.find("strong")
-                if strong_element:
-                    run = paragraph.runs[0]
-                    run.bold = True
-                continue
-            if line.name == "pre":
-                do_pre_code(line, doc, style_quote_table)
-            if line.name == "table":
-                this_table_in = list_of_tables[table_counter]
-                do_table(doc, this_table_in, style_table)
-                table_counter += 1
-                continue
-            if line.name == "ul":  # unordered list (bullets)
-                parser = HtmlListParser()
-                parser.doc = doc
-                parser.feed(str(line))
-                continue
-            if line.name == "ol":  # ordered list (numbered)
-                parser = HtmlListParser()
-                HtmlListParser.lists = ["List Number", "List Number 2", "List Number 3"]
-                HtmlListParser.spare_list = "#  "
-                parser.doc = doc
-                parser.feed(str(line))
-                continue
-            if line.name == "blockquote":
-                do_blockquote(line, doc, style_blockquote)
-                continue
-            if line.name == "strong":
-                do_strong_text(line, doc, style_strong_text)
-                continue
-    return doc
+    Process the object to render a Word docx.
+    state carries the table of contents progress between calls when a
+    document is rendered one block at a time. images holds pictures prepared
+    by an ImagePipeline. handlers replaces default_handlers, see SoupRenderer.
+    bulk_tables draws tables with add_table_bulk(). Pictures are read
+    relative to base_dir, the current directory if None. metrics is a
+    Metrics.MetricsSink to report to. theme names the styles of the blocks
+    that have no style_* argument, see Theme."""
+    return SoupRenderer(
+        doc,
+        page_width_inches,
+        style_quote_table,
+        style_body,
+        style_table,
+        heading_style,
+        style_blockquote,
+        style_strong_text,
+        table_of_contents_string=table_of_contents_string,
+        state=state,
+        images=images,
+        handlers=handlers,
+        bulk_tables=bulk_tables,
+        base_dir=base_dir,
+        metrics=metrics,
+        theme=theme,
+    ).render(soup)
 
 
 class HtmlListParser(HTMLParser):
     list_level = -1
-    lists = ["List Bullet", "List Bullet 2", "List Bullet 3"]
+    lists = ("List Bullet", "List Bullet 2", "List Bullet 3")
+    ordered_lists = ("List Number", "List Number 2", "List Number 3")
     doc = None  # the .docx document object
     spacing = "    "  # used if we run out of bullet levels
     spare_list = "○  "
+    ordered_spare_list = "#  "
+
+    def __init__(self, doc=None, ordered=False):
+        super().__init__()
+        self.doc = doc
+        if ordered:  # set on the instance, every list starts from the defaults
+            self.lists = self.ordered_lists
+            self.spare_list = self.ordered_spare_list
 
     def handle_starttag(self, tag, attrs):
         if tag in ["ol", "ul"]:
@@ -300,67 +1036,272 @@ class HtmlListParser(HTMLParser):
     def handle_data(self, data):
         data = data.strip()
         if data:
-            if self.list_level in range(len(self.lists)):
-                self.doc.add_paragraph(data, self.lists[self.list_level])
-            else:
-                self.doc.add_paragraph(
-                    "        " + self.spacing * self.list_level + self.spare_list + data
-                )
+            self.add_item(data, self.list_level)
+
+    def add_item(self, data, list_level):
+        if list_level in range(len(self.lists)):
+            add_styled_paragraph(self.doc, data, self.lists[list_level])
+        else:
+            self.doc.add_paragraph(
+                "        " + self.spacing * list_level + self.spare_list + data
+            )
+
+
+def new_list_parser(doc, ordered=False):
+    return HtmlListParser(doc, ordered)
+
+
+_class_styles = (
+    "style_table",
+    "style_quote",
+    "style_body",
+    "style_quote_table",
+    "style_blockquote",
+    "style_strong_text",
+)
+
+
+def _with_class_styles(cls, theme):
+    """theme, or a copy of it taking over the style_* class attributes that
+    cls changes from the default theme's (the way styles were set before
+    there were themes)."""
+    changed = {
+        name: getattr(cls, name)
+        for name in _class_styles
+        if getattr(cls, name) != getattr(default_theme, name)
+        and getattr(cls, name) != getattr(theme, name)
+    }
+    if not changed:
+        return theme
+    warnings.warn(
+        f"{cls.__name__} sets {', '.join(changed)}; set them on a Theme instead",
+        DeprecationWarning,
+        stacklevel=3,
+    )
+    theme = copy.copy(theme)
+    if "style_body" in changed:
+        theme.style_paragraph = _paragraph_style(theme, theme, changed["style_body"])
+    for name, value in changed.items():
+        setattr(theme, name, value)
+    return theme
 
 
 class Markdown2docx:
-    style_table = "Medium Shading 1 Accent 3"
-    style_quote = "Body Text"
-    style_body = "Body Text"
-    style_quote_table = "Table Grid"
-    style_blockquote = "Quote"
-    style_strong_text = "Strong Text"
+    theme = default_theme  # see Theme, or pass theme= for one conversion
     toc_indicator = "contents"
+    # deprecated, set them on a Theme instead: a subclass that overrides one
+    # of these still has it written, by a copy of its theme taking it over
+    style_table = default_theme.style_table
+    style_quote = default_theme.style_quote
+    style_body = default_theme.style_body
+    style_quote_table = default_theme.style_quote_table
+    style_blockquote = default_theme.style_blockquote
+    style_strong_text = default_theme.style_strong_text
 
-    def __init__(self, project, markdown=None, file_stream=None):
+    def __init__(
+        self,
+        project,
+        markdown=None,
+        file_stream=None,
+        streaming=False,
+        template=None,
+        image_pipeline=None,
+        engine="soup",
+        bulk_tables=False,
+        base_dir=None,
+        metrics=None,
+        image_resolver=None,
+        compresslevel=None,
+        theme=None,
+        workers=None,
+        static_toc=False,
+    ):
         self.infile = ".".join([project, "md"])
         self.outfile = ".".join([project, "docx"])
         self.html_out_file = ".".join([project, "html"])
         self.project = project
-        self.doc = docx.Document()
-
-        self.heading_style = self.doc.styles.add_style(
-            "Custom Heading", WD_STYLE_TYPE.PARAGRAPH
-        )
-        self.heading_style.base_style = self.doc.styles["Heading 2"]
-        self.heading_style.font.color.rgb = RGBColor(0, 0, 0)
-        self.heading_style.font.size = Pt(18)
-        self.heading_style.font.name = "Verdana"
-        self.heading_style.paragraph_format.space_before = Pt(12)
-        self.heading_style.paragraph_format.space_after = Pt(6)
-
-        self.style_blockquote = self.doc.styles.add_style(
-            "Custom Quote", WD_STYLE_TYPE.PARAGRAPH
-        )
-
-        self.style_blockquote.base_style = self.doc.styles["Normal"]
-        self.style_blockquote.font.size = Pt(11)
-        self.style_blockquote.font.italic = True
-        self.style_blockquote.paragraph_format.space_before = Pt(6)
-        self.style_blockquote.paragraph_format.space_after = Pt(6)
-
-        add_style_strong_text(self.doc)
+        self.template = template
+        self.image_pipeline = image_pipeline
+        # image_resolver(src) returns a picture's bytes instead of a file being
+        # read, see resolve_images(); it takes precedence over image_pipeline
+        self.image_resolver = image_resolver
+        self.handlers = dict(default_handlers)
+        self.bulk_tables = bulk_tables
+        # pictures are found relative to base_dir rather than the current
+        # directory, which is shared by every thread in the process
+        self.base_dir = base_dir
+        # a Metrics.MetricsSink told about every stage, None for no overhead
+        self.metrics = metrics
+        if theme is not None:
+            self.theme = theme
+        self.theme = _with_class_styles(type(self), self.theme)
+        # the styled base document is built once per template and theme and
+        # copied here; the blocks are then written in its styles by name
+        self.doc = base_document(template, self.theme)
+        self.style_table = self.theme.style_table
+        self.style_quote = self.theme.style_quote
+        self.style_body = self.theme.style_body
+        self.style_quote_table = self.theme.style_quote_table
+        self.style_blockquote = self.theme.style_blockquote
+        self.style_strong_text = self.theme.style_strong_text
+        self.heading_style = self.theme.style_heading
 
         self.file_stream = file_stream
+        # 0 (stored) to 9 (smallest) for the parts of the .docx, None for zlib's default
+        self.compresslevel = compresslevel
+        # eat_soup() renders the parsed document on this many processes, see
+        # ParallelMarkdown2docx; streaming and the direct engine render serially
+        self.workers = workers
+        # save() writes the table of contents' entries, see TableOfContents;
+        # "pages" gives them estimated page numbers
+        self.static_toc = static_toc
         self.page_width_inches = find_page_width(self.doc)
         # self.html = markdown.markdown(_read_in_markdown(self.infile), extensions=['tables'])
         self.markdown = markdown
-        self.html = markdown2.markdown(
-            self.markdown,
-            extras=["fenced-code-blocks", "code-friendly", "wiki-tables", "tables"],
-        )
+        self.streaming = streaming
+        # "soup" renders markdown2's HTML, "direct" renders the markdown tokens
+        self.engine = engine
+        # the reference link definitions every block needs to resolve its links
+        self.link_definitions = []
+        if streaming or engine == "direct":
+            # markdown may be any iterable of lines; each block is converted
+            # and rendered by eat_soup() as it is read.
+            self.html = None
+            self.soup = None
+            self._definitions_known = isinstance(markdown, (str, list, tuple))
+            if self._definitions_known:
+                self.link_definitions = link_definitions(markdown)
+            return
+        import markdown2
+        from bs4 import BeautifulSoup
 
-        self.soup = BeautifulSoup(self.html, "html.parser")
+        with timed(metrics, "markdown2"):
+            self.html = markdown2.markdown(self.markdown, extras=markdown_extras)
+
+        with timed(metrics, "soup"):
+            self.soup = BeautifulSoup(self.html, "html.parser")
         # return self.soup
 
     def eat_soup(self):
+        with timed(self.metrics, "render"):
+            if self.soup is not None and self.workers is not None and self.workers > 1:
+                from ParallelMarkdown2docx import render_parallel
+
+                render_parallel(self, self.workers)
+            elif self.engine == "direct":
+                self._eat_direct()
+            elif self.streaming:
+                self._eat_blocks()
+            else:
+                self._eat(self.soup)
+
+    def eat_block(self, block, state):
+        """Render one top-level block, as split by split_markdown_blocks(), with
+        this converter's engine. state carries the table of contents progress
+        from one block to the next."""
+        if self.engine == "direct":
+            self._eat_direct_block(block, state)
+            return
+        self._eat_markdown(block, state)
+
+    def _eat_markdown(self, block, state):
+        import markdown2
+        from bs4 import BeautifulSoup
+
+        if self.link_definitions:
+            block = "\n".join([block, *self.link_definitions, ""])
+        with timed(self.metrics, "markdown2"):
+            html = markdown2.markdown(block, extras=markdown_extras)
+        with timed(self.metrics, "soup"):
+            soup = BeautifulSoup(html, "html.parser")
+        self._eat(soup, state)
+
+    def _split_blocks(self):
+        # a stream of lines is read once, so its definitions are gathered as
+        # it is split, and only the links after their definition resolve
+        definitions = None if self._definitions_known else self.link_definitions
+        return split_markdown_blocks(self.markdown, definitions)
+
+    def _eat_direct(self):
+        state = {"table_of_contents_done": 0}
+        for block in self._split_blocks():
+            self._eat_direct_block(block, state)
+
+    def _eat_direct_block(self, block, state):
+        from DirectMarkdown2docx import emit_block, token_tag, tokenize_block
+
+        token = tokenize_block(block)
+        if token is None or self._overridden(token_tag(token)):
+            self._eat_markdown(block, state)
+            return
+        images = None
+        if token[0] == "image":
+            images = self._prepare_images([token[1]])
+
+        def emit():
+            emit_block(
+                token,
+                self.doc,
+                self.page_width_inches,
+                self.style_quote_table,
+                self.style_body,
+                self.style_table,
+                self.heading_style,
+                self.style_blockquote,
+                table_of_contents_string=self.toc_indicator,
+                state=state,
+                images=images,
+                bulk_tables=self.bulk_tables,
+                base_dir=self.base_dir,
+                theme=self.theme,
+            )
+
+        if self.metrics is None:
+            emit()
+            return
+        tag = token_tag(token)
+        with timed(self.metrics, "tag", tag=tag):
+            emit()
+        self.metrics.count("blocks", tag=tag)
+        if token[0] == "table":
+            self.metrics.count("table_cells", len(token[1]) + len(token[2]))
+        elif token[0] == "image":
+            self.metrics.count("images")
+            self.metrics.count("image_bytes", image_bytes(token[1], images, self.base_dir))
+
+    def register_handler(self, tag, handler):
+        """Render tag with handler(renderer, node) instead of the default, see
+        SoupRenderer. None stops the tag being rendered."""
+        if handler is None:
+            self.handlers.pop(tag, None)
+        else:
+            self.handlers[tag] = handler
+
+    def _overridden(self, tag):
+        return self.handlers.get(tag) is not default_handlers.get(tag)
+
+    def _eat_blocks(self):
+        state = {"table_of_contents_done": 0}
+        for block in self._split_blocks():
+            self.eat_block(block, state)
+
+    def _prepare_images(self, sources):
+        if self.image_resolver is not None:
+            with timed(self.metrics, "images"):
+                return resolve_images(self.image_resolver, sources, self.page_width_inches)
+        if self.image_pipeline is not None:
+            with timed(self.metrics, "images"):
+                return self.image_pipeline.prepare(sources, self.page_width_inches)
+        return None
+
+    def _eat(self, soup, state=None):
+        images = None
+        if self.image_pipeline is not None or self.image_resolver is not None:
+            sources = [image["src"] for image in soup.find_all("img", src=True)]
+            if sources:
+                images = self._prepare_images(sources)
         _eat_soup(
-            self.soup,
+            soup,
             self.doc,
             self.page_width_inches,
             self.style_quote_table,
@@ -370,6 +1311,13 @@ class Markdown2docx:
             self.style_blockquote,
             self.style_strong_text,
             table_of_contents_string=self.toc_indicator,
+            state=state,
+            images=images,
+            handlers=self.handlers,
+            bulk_tables=self.bulk_tables,
+            base_dir=self.base_dir,
+            metrics=self.metrics,
+            theme=self.theme,
         )
 
     def __del__(self):
@@ -405,13 +1353,114 @@ class Markdown2docx:
         }
 
     def write_html(self):
-        write_out_html(self.html_out_file, self.html)
+        if self.html is not None:
+            write_out_html(self.html_out_file, self.html)
+            return
+        import markdown2
+
+        with open(self.html_out_file, "w", encoding="utf8") as output_fd:
+            for block in self._split_blocks():
+                block = "\n".join([block, *self.link_definitions, ""])
+                output_fd.write(markdown2.markdown(block, extras=markdown_extras))
 
     def save(self):
-        self.doc.save(self.file_stream)
+        from PackageWriter import write_package
+
+        if self.static_toc:
+            from TableOfContents import fill_table_of_contents
+
+            with timed(self.metrics, "table_of_contents"):
+                fill_table_of_contents(self.doc, page_numbers=self.static_toc == "pages")
+        with timed(self.metrics, "save"):
+            write_package(self.doc, self.file_stream, self.compresslevel)
+
+
+def preprocess(
+    markdown, macros=None, cwd=None, encoding="utf8", project="document", metrics=None
+):
+    """The first step of convert(): the PreprocessMarkdown2docx of markdown
+    (str or bytes in encoding) and its lines with the macros substituted,
+    for its ${commands} to be run on them or not."""
+    if isinstance(markdown, (bytes, bytearray, memoryview)):
+        markdown = str(markdown, encoding)
+    from PreprocessMarkdown2docx import PreprocessMarkdown2docx, resolve_macros
+
+    library = resolve_macros(macros) if macros else None
+    ppm2w = PreprocessMarkdown2docx(
+        project, macro_library=library, cwd=cwd, metrics=metrics, text=markdown
+    )
+    return ppm2w, ppm2w.do_substitute_tokens(ppm2w.get_all_but_macros())
+
+
+def render_docx(project, markdown, output, resolve_image=None, **options):
+    """The last step of convert(), the one that is CPU bound: parse and render
+    preprocessed markdown and save the docx to output."""
+    converter = Markdown2docx(
+        project, markdown, file_stream=output, image_resolver=resolve_image, **options
+    )
+    converter.eat_soup()
+    converter.save()
+
+
+def convert(
+    markdown,
+    macros=None,
+    resolve_image=None,
+    stream=None,
+    run_commands=False,
+    cwd=None,
+    encoding="utf8",
+    project="document",
+    cache=None,
+    **options,
+):
+    """Convert markdown (str or bytes in encoding) to docx in memory.
+
+    macros is a dict of __token__ -> value used like a macro library; the
+    document's own MaCrOs block takes precedence. resolve_image(src) returns
+    a picture's bytes or a binary file object, or None if there is none (see
+    resolve_images()); without it pictures are read from files. ${commands}
+    are only run with run_commands=True, in cwd, as they run on this machine.
+    options go to Markdown2docx, e.g. template, engine or metrics.
+    With an OutputCache as cache, a document converted before is not
+    rendered again: its docx comes from the cache.
+
+    Returns the docx as bytes, or writes it to stream and returns None.
+    Nothing is written to disk, except to the cache, and the current
+    directory is not used."""
+    ppm2w, lines = preprocess(
+        markdown, macros, cwd, encoding, project, options.get("metrics")
+    )
+    if run_commands:
+        lines = ppm2w.do_execute_commands(lines)
+    markdown = "\n".join(lines)
+
+    def render(output):
+        render_docx(project, markdown, output, resolve_image, **options)
+
+    if cache is not None:
+        pictures = {}
+        key = cache.key(markdown, resolve_image, pictures=pictures, **options)
+        if resolve_image is not None:
+            resolve = resolve_image
+
+            def resolve_image(src):  # the key has resolved the pictures already
+                return pictures[src] if src in pictures else resolve(src)
+
+        data, _ = cache.get_or_render(key, render)
+        if stream is None:
+            return data
+        stream.write(data)
+        return None
+    output = io.BytesIO() if stream is None else stream
+    render(output)
+    if stream is None:
+        return output.getvalue()
 
 
 def __main__(project):
+    from PreprocessMarkdown2docx import PreprocessMarkdown2docx
+
     ppm2w = PreprocessMarkdown2docx(project)
     markdown = ppm2w.get_all_but_macros()
     markdown = ppm2w.do_substitute_tokens(markdown)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import os
+import sys
+import time
+
+from BatchMarkdown2docx import collect_markdown_files
+from Markdown2docx import (
+    Markdown2docx,
+    base_document,
+    link_definitions,
+    split_markdown_blocks,
+)
+from PreprocessMarkdown2docx import PreprocessMarkdown2docx, shared_macros
+
+"""
+    Merge chapter files into one docx, rendering the chapters in parallel.
+
+        $ markdown2docx-merge intro.md chapters/*.md -o manual.docx -j 8
+
+    The macros of all the chapters form one scope (see shared_macros()), so a
+    chapter may use a macro another chapter defines. Each chapter is then
+    preprocessed, with its ${commands} run in its own directory, and rendered
+    on a pool of worker processes into a fragment of body XML with the
+    pictures it embeds. The fragments are spliced into one document in the
+    order given, the way IncrementalMarkdown2docx splices kept blocks:
+    pictures are related to the merged document and numbered afresh, and the
+    style changes rendering makes are applied once. Every chapter starts from
+    the same styled base document, so the styles and the list numbering of
+    the chapters agree.
+
+    There is a single table of contents. The first chapter places it as a
+    single document would, by the table of contents indicator; the indicator
+    is ignored in the chapters after it. A page break goes before every
+    chapter but the first, unless page_breaks is False.
+"""
+
+
+class MergeError(Exception):
+    """A chapter could not be preprocessed or rendered. The message names the
+    chapter, the original error is the cause."""
+
+
+def _render_chapter(file_name, macro_library, first, options):
+    """Preprocess and render one chapter in a worker process. Returns its
+    Fragment with the XML as bytes, so that it can be sent back."""
+    from IncrementalMarkdown2docx import render_portable_fragment
+
+    source = os.path.abspath(file_name)
+    directory, base = os.path.split(source)
+    project = os.path.join(directory, base[:-3] if base.endswith(".md") else base)
+    ppm2w = PreprocessMarkdown2docx(project, macro_library=macro_library, cwd=directory)
+    markdown = ppm2w.get_all_but_macros()
+    markdown = ppm2w.do_substitute_tokens(markdown)
+    markdown = ppm2w.do_execute_commands(markdown)
+    converter = Markdown2docx(
+        project, file_stream=io.BytesIO(), streaming=True, base_dir=directory, **options
+    )
+    converter.link_definitions = link_definitions(markdown)
+
+    def render(state):
+        for block in split_markdown_blocks(markdown):
+            converter.eat_block(block, state)
+
+    # only the first chapter may place the table of contents
+    return render_portable_fragment(
+        converter, render, {"table_of_contents_done": 0 if first else 2}
+    )
+
+
+def _chapter_fragments(files, macro_library, workers, options):
+    """The Fragment of each file, in order, rendered on workers processes,
+    or in this process with workers=1."""
+    jobs = [(file_name, macro_library, n == 0, options) for n, file_name in enumerate(files)]
+    if workers == 1:
+        for job in jobs:
+            try:
+                yield _render_chapter(*job)
+            except Exception as e:
+                raise MergeError(f"{job[0]}: {type(e).__name__}: {e}") from e
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_render_chapter, *job) for job in jobs]
+        for file_name, future in zip(files, futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                for pending in futures:
+                    pending.cancel()
+                raise MergeError(f"{file_name}: {type(e).__name__}: {e}") from e
+
+
+def merge_markdown_files(
+    files,
+    file_stream,
+    workers=None,
+    page_breaks=True,
+    macro_library=None,
+    template=None,
+    engine="soup",
+    bulk_tables=False,
+    compresslevel=None,
+    theme=None,
+    static_toc=False,
+):
+    """Convert the markdown files, in order, into one docx written to
+    file_stream, rendering the chapters on workers processes (all the CPUs
+    if None). Pictures and ${commands} are resolved relative to each
+    chapter. A chapter that fails raises MergeError, the macros MacroError.
+    Every chapter is styled by theme, see Markdown2docx.Theme. With
+    static_toc the entries of the table of contents are written, with
+    estimated page numbers if it is "pages", see TableOfContents."""
+    from IncrementalMarkdown2docx import splice_portable_fragment
+    from PackageWriter import write_package
+
+    files = list(files)
+    workers = min(workers or os.cpu_count() or 1, max(1, len(files)))
+    library = shared_macros(
+        [os.path.splitext(os.path.abspath(file_name))[0] for file_name in files], macro_library
+    )
+    options = {"template": template, "engine": engine, "bulk_tables": bulk_tables, "theme": theme}
+    doc = base_document(template, theme)
+    for n, fragment in enumerate(_chapter_fragments(files, library, workers, options)):
+        if n and page_breaks:
+            doc.add_page_break()
+        splice_portable_fragment(doc, fragment)
+    if static_toc:
+        from TableOfContents import fill_table_of_contents
+
+        fill_table_of_contents(doc, page_numbers=static_toc == "pages")
+    write_package(doc, file_stream, compresslevel)
+    return doc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge markdown chapters into one docx.")
+    parser.add_argument("files", nargs="*", help="markdown files or glob patterns, in order")
+    parser.add_argument("-m", "--manifest", help="file listing the chapters in order")
+    parser.add_argument("-o", "--output", required=True, help="the .docx to write")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument(
+        "--no-page-breaks", action="store_true", help="run the chapters on without a break"
+    )
+    parser.add_argument("--template", help="a .docx to take the styles from")
+    parser.add_argument("--engine", choices=["soup", "direct"], default="soup")
+    parser.add_argument(
+        "--static-toc",
+        choices=["links", "pages"],
+        help="write the table of contents' entries, with estimated page numbers or none",
+    )
+    args = parser.parse_args(argv)
+    files = collect_markdown_files(args.files, args.manifest)
+    if not files:
+        parser.error("no markdown files given")
+    started = time.perf_counter()
+    try:
+        merge_markdown_files(
+            files,
+            args.output,
+            workers=args.jobs,
+            page_breaks=not args.no_page_breaks,
+            template=args.template,
+            engine=args.engine,
+            static_toc=args.static_toc,
+        )
+    except Exception as e:
+        print(f"ERROR {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    print(
+        f"{len(files)} chapters -> {args.output} ({time.perf_counter() - started:.2f}s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
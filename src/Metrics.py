@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import contextlib
+import os
+import sys
+import threading
+import time
+
+"""
+    Timings and counters for a conversion.
+
+    Markdown2docx and PreprocessMarkdown2docx take a metrics sink. The sink is
+    told when each stage starts and stops, with its duration, and is given
+    counters such as the blocks rendered per tag or the bytes of each picture.
+    Details such as the tag or the command are passed as keyword arguments.
+    Commands are timed on worker threads, so a sink must be thread-safe.
+    Without a sink, every hook is one "is None" test.
+
+    Stages: preprocess.scan, preprocess.macros, preprocess.substitute,
+    preprocess.commands, command (command=...), markdown2, soup, render,
+    tag (tag=...), images and save.
+    Counters: macro_substitutions, commands_run, commands_cached,
+    blocks (tag=...), table_cells, images and image_bytes.
+
+    profile_to() records one conversion with cProfile, or as folded stacks
+    for flamegraph.pl, speedscope and the like.
+"""
+
+
+class MetricsSink:
+    """Receives the timings and counters of conversions. The methods here do
+    nothing; override the ones you need."""
+
+    def start(self, stage, **details):
+        pass
+
+    def stop(self, stage, seconds, **details):
+        pass
+
+    def count(self, counter, value=1, **details):
+        pass
+
+
+def _key(name, details):
+    if not details:
+        return name
+    return f"{name}[{','.join(str(value) for value in details.values())}]"
+
+
+class RecordingSink(MetricsSink):
+    """Total up the stages and counters, both overall and per detail, e.g.
+    "tag" and "tag[table]". report() returns what has been recorded."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}  # stage -> [calls, seconds]
+        self.counters = {}  # counter -> total
+
+    def stop(self, stage, seconds, **details):
+        keys = (stage, _key(stage, details)) if details else (stage,)
+        with self._lock:
+            for key in keys:
+                totals = self.stages.setdefault(key, [0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+
+    def count(self, counter, value=1, **details):
+        keys = (counter, _key(counter, details)) if details else (counter,)
+        with self._lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def report(self):
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {"calls": calls, "seconds": seconds}
+                    for stage, (calls, seconds) in self.stages.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+
+class _Timing:
+    __slots__ = ("metrics", "stage", "details", "started")
+
+    def __init__(self, metrics, stage, details):
+        self.metrics = metrics
+        self.stage = stage
+        self.details = details
+
+    def __enter__(self):
+        self.metrics.start(self.stage, **self.details)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.stop(self.stage, time.perf_counter() - self.started, **self.details)
+        return False
+
+
+_not_timed = contextlib.nullcontext()
+
+
+def timed(metrics, stage, **details):
+    """A context manager reporting the time spent in its block to metrics as
+    stage. Does nothing when metrics is None."""
+    if metrics is None:
+        return _not_timed
+    return _Timing(metrics, stage, details)
+
+
+def _label(code):
+    return f"{os.path.splitext(os.path.basename(code.co_filename))[0]}.{code.co_name}"
+
+
+class _FoldedStacks:
+    """Time spent in each call stack of this thread, to write as folded stacks:
+    one "outer;inner;innermost microseconds" line per stack."""
+
+    def __init__(self):
+        self.stack = []  # [label, started, time in callees]
+        self.totals = {}
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == "call":
+            self.stack.append([_label(frame.f_code), now, 0.0])
+        elif event == "c_call":
+            self.stack.append([f"<{getattr(arg, '__qualname__', arg)}>", now, 0.0])
+        elif event in ("return", "c_return", "c_exception") and self.stack:
+            key = ";".join(entry[0] for entry in self.stack)
+            label, started, in_callees = self.stack.pop()
+            elapsed = now - started
+            self.totals[key] = self.totals.get(key, 0.0) + elapsed - in_callees
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def write(self, path):
+        with open(path, "w", encoding="utf8") as folded_fd:
+            for key, seconds in sorted(self.totals.items()):
+                microseconds = round(seconds * 1e6)
+                if microseconds:
+                    folded_fd.write(f"{key} {microseconds}\n")
+
+
+@contextlib.contextmanager
+def profile_to(path):
+    """Profile the code run inside the with block on this thread. A path
+    ending in .prof gets cProfile stats (for pstats, snakeviz, ...); any other
+    path gets folded stacks for a flame graph."""
+    if path.endswith(".prof"):
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+        return
+    stacks = _FoldedStacks()
+    previous = sys.getprofile()
+    sys.setprofile(stacks)
+    try:
+        yield
+    finally:
+        sys.setprofile(previous)
+        stacks.write(path)
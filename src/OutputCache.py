@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import hashlib
+import io
+import os
+import threading
+
+from Markdown2docx import __version__, default_theme, image_sources
+
+"""
+    A cache of whole .docx outputs, so that a document that has not changed is
+    not converted again.
+
+    An entry is keyed on a digest of everything the output depends on: the
+    preprocessed markdown, which holds the source with its macro values and
+    command outputs substituted, the bytes of every picture it refers to, the
+    template's bytes, the theme, the rendering options and the version of
+    Markdown2docx. On a hit the stored .docx bytes are returned as they are,
+    without markdown2, BeautifulSoup, rendering or saving.
+
+    The entries are kept by a store. DirectoryStore keeps them as files under
+    a directory and evicts the least recently used once they pass max_bytes.
+    Any object with get(key), put(key, data) and stats() will do as a store.
+"""
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "markdown2docx", "outputs")
+
+
+class DirectoryStore:
+    """Entries as <directory>/<key[:2]>/<key>.docx. A file's modification time
+    is when it was last used; once the entries take more than max_bytes the
+    oldest are deleted. Several processes may share a directory: files are
+    written under a temporary name and renamed into place."""
+
+    max_bytes = 512 * 1024 * 1024
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or default_cache_dir()
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.docx")
+
+    def get(self, key):
+        """The bytes stored under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry_fd:
+                data = entry_fd.read()
+            os.utime(path)  # the entry is recently used now
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}-{threading.get_ident()}"
+        with open(partial, "wb") as entry_fd:
+            entry_fd.write(data)
+        os.replace(partial, path)
+        with self._lock:
+            self._evict()
+
+    def _entries(self):
+        """(modification time, size, path) of every entry."""
+        entries = []
+        for folder in os.scandir(self.directory):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith(".docx"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:  # evicted by another process
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_template_digests = {}  # (path, mtime, size) -> sha256 of the template
+
+
+def _file_digest(file_name):
+    stat = os.stat(file_name)
+    signature = os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size
+    digest = _template_digests.get(signature)
+    if digest is None:
+        with open(file_name, "rb") as file_fd:
+            digest = hashlib.sha256(file_fd.read()).hexdigest()
+        _template_digests[signature] = digest
+    return digest
+
+
+def _picture_bytes(src, resolve_image=None, base_dir=None):
+    """The bytes Markdown2docx would read for the picture src, or None."""
+    if resolve_image is not None:
+        data = resolve_image(src)
+        return data.read() if hasattr(data, "read") else data
+    try:
+        path = src if base_dir is None else os.path.join(base_dir, src)
+        with open(path, "rb") as image_fd:
+            return image_fd.read()
+    except OSError:
+        return None
+
+
+# options that do not change the output
+_unkeyed_options = ("metrics", "base_dir", "file_stream")
+
+
+class OutputCache:
+    """Whole outputs in store, a DirectoryStore under directory if None.
+    hits and misses count the lookups of this object."""
+
+    def __init__(self, directory=None, max_bytes=None, store=None):
+        self.store = DirectoryStore(directory, max_bytes) if store is None else store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(
+        self,
+        markdown,
+        resolve_image=None,
+        base_dir=None,
+        template=None,
+        theme=None,
+        pictures=None,
+        **options,
+    ):
+        """The digest of markdown, already preprocessed, and what else its
+        output depends on. Pictures are read as Markdown2docx would read them,
+        from resolve_image or from files relative to base_dir; given a dict as
+        pictures, their bytes (None if missing) are kept in it by src, so that
+        rendering need not read them again. options are the other
+        Markdown2docx options."""
+        digest = hashlib.sha256()
+
+        def add(part):
+            digest.update(part if isinstance(part, bytes) else str(part).encode("utf8"))
+            digest.update(b"\0")
+
+        add(f"Markdown2docx {__version__}")
+        add(markdown)
+        for src in dict.fromkeys(image_sources(markdown)):
+            data = _picture_bytes(src, resolve_image, base_dir)
+            if pictures is not None:
+                pictures[src] = data
+            add(src)
+            add("missing" if data is None else hashlib.sha256(data).digest())
+        add("default template" if template is None else _file_digest(template))
+        add((default_theme if theme is None else theme).key())
+        for name, value in sorted(options.items()):
+            if name in _unkeyed_options:
+                continue
+            if name == "image_pipeline" and value is not None:
+                value = getattr(value, "target_dpi", None)  # how it changes pictures
+            add(f"{name}={value!r}")
+        return digest.hexdigest()
+
+    def get(self, key):
+        data = self.store.get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.store.put(key, data)
+
+    def get_or_render(self, key, render):
+        """The output stored under key, or else what render(file_stream)
+        writes, which is then stored. Returns (docx bytes, True if they came
+        from the cache)."""
+        data = self.get(key)
+        if data is not None:
+            return data, True
+        output = io.BytesIO()
+        render(output)
+        data = output.getvalue()
+        self.put(key, data)
+        return data, False
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            **self.store.stats(),
+        }
+
+    def clear(self):
+        self.store.clear()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import zipfile
+
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.part import XmlPart
+from docx.opc.pkgwriter import _ContentTypesItem
+from lxml import etree
+
+"""
+    Write a python-docx document to a .docx without building it in memory.
+
+    Document.save() serializes every part to one bytes object and adds it to
+    the zip whole, so on save a large document.xml is held twice, once as the
+    lxml tree and once as text, besides the compressed archive. write_package()
+    streams each part into its zip entry instead: the XML parts are serialized
+    straight into the compressor a few kilobytes at a time and the pictures
+    are fed in from the bytes the document already holds, without a copy.
+
+    The parts, their names, order and content are those Document.save() writes,
+    so the file opens in Word and LibreOffice as before. compresslevel trades
+    speed for size: 0 stores the parts uncompressed, 1 is fastest, 9 smallest
+    and None is zlib's default, as Document.save() uses. The members are
+    stamped with the zip format's earliest date rather than the time of saving,
+    so a document saved twice gives the same bytes.
+"""
+
+chunk_size = 1 << 16  # bytes of a picture passed to the compressor at a time
+
+
+def _write_member(zipf, membername, blob):
+    with zipf.open(membername, "w") as member:
+        view = memoryview(blob)
+        for start in range(0, len(view), chunk_size):
+            member.write(view[start : start + chunk_size])
+
+
+def _write_xml(zipf, membername, element):
+    with zipf.open(membername, "w") as member:
+        # the same bytes as docx.opc.oxml.serialize_part_xml(), a buffer at a time
+        etree.ElementTree(element).write(member, encoding="UTF-8", standalone=True)
+
+
+def write_package(doc, file_stream, compresslevel=None):
+    """Save doc, a python-docx Document, to file_stream, a path or a binary
+    file object, streaming each part into the archive."""
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+    compression = zipfile.ZIP_STORED if compresslevel == 0 else zipfile.ZIP_DEFLATED
+    # every member is opened by name, so it takes the compression of the archive
+    with zipfile.ZipFile(
+        file_stream, "w", compression=compression, compresslevel=compresslevel
+    ) as zipf:
+        content_types = _ContentTypesItem.from_parts(parts).blob
+        _write_member(zipf, CONTENT_TYPES_URI.membername, content_types)
+        _write_member(zipf, PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        for part in parts:
+            if isinstance(part, XmlPart):
+                _write_xml(zipf, part.partname.membername, part.element)
+            else:
+                _write_member(zipf, part.partname.membername, part.blob)
+            if len(part.rels):
+                _write_member(zipf, part.partname.rels_uri.membername, part.rels.xml)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import io
+
+from Markdown2docx import default_handlers, mentions_table_of_contents
+
+"""
+    Render one large document on several processes.
+
+        project = Markdown2docx('manual', markdown, workers=8)
+        project.eat_soup()
+
+    The parsed document (the soup eat_soup() renders) is cut into contiguous
+    ranges of top-level nodes at its h1 and h2 headings, a few ranges per
+    worker, each of about the same length. A range is sent as its slice of
+    the HTML the soup was parsed from. Each range is rendered in a worker
+    process into a fragment of body XML with the pictures it embeds, in a
+    document made from the same base document, so styles and list numbering
+    agree. The fragments are spliced into the document in order, whichever
+    finishes first, the way IncrementalMarkdown2docx splices kept blocks:
+    pictures are related in order and numbered afresh. The result is the
+    document the serial eat_soup() writes.
+
+    Where the table of contents goes depends on the nodes before it, so the
+    progress at the start of each range is worked out before the ranges are
+    sent out. Handlers registered with register_handler(), the image resolver
+    and the image pipeline are sent to the workers, and must pickle. The
+    workers do not report to a metrics sink.
+"""
+
+ranges_per_worker = 4  # more, smaller ranges even out the work
+min_range_chars = 20000  # ranges are not made smaller than this
+
+
+def _serialize(node):
+    """node as HTML that html.parser reads back as the same node."""
+    from bs4 import Tag
+
+    return str(node) if isinstance(node, Tag) else node.output_ready()
+
+
+def _sections(nodes):
+    """Split the top-level nodes into runs that each start at an h1 or h2."""
+    section = []
+    for node in nodes:
+        if getattr(node, "name", None) in ("h1", "h2") and section:
+            yield section
+            section = []
+        section.append(node)
+    if section:
+        yield section
+
+
+def _sections_html(html, sections):
+    """The HTML of each section, cut from html, which the soup was parsed
+    from, where the heading starting the section begins. None if the parser
+    did not record where the headings are."""
+    if html is None:
+        return None
+    line_starts = [0]
+    position = html.find("\n")
+    while position >= 0:
+        line_starts.append(position + 1)
+        position = html.find("\n", position + 1)
+    cuts = [0]
+    for section in sections[1:]:
+        heading = section[0]
+        if heading.sourceline is None:
+            return None
+        cut = line_starts[heading.sourceline - 1] + heading.sourcepos
+        if not html.startswith(f"<{heading.name}", cut):
+            return None
+        cuts.append(cut)
+    cuts.append(len(html))
+    return [html[start:end] for start, end in zip(cuts, cuts[1:])]
+
+
+def split_ranges(sections, parts):
+    """Group sections, each as HTML, into about parts ranges of contiguous
+    sections of similar length. Returns (index of the first section, HTML)
+    for each range."""
+    total = sum(len(section) for section in sections)
+    target = max(min_range_chars, total // max(1, parts))
+    ranges, first, current, size = [], 0, [], 0
+    for n, section in enumerate(sections):
+        current.append(section)
+        size += len(section)
+        if size >= target or n == len(sections) - 1:
+            ranges.append((first, "".join(current)))
+            first, current, size = n + 1, [], 0
+    return ranges
+
+
+def _start_states(sections, toc_indicator):
+    """The table of contents progress at the start of every section of nodes."""
+    done = 0
+    states = []
+    for section in sections:
+        states.append(done)
+        for node in section:
+            if done < 2 and mentions_table_of_contents(node, toc_indicator):
+                done += 1
+    return states
+
+
+def _render_range(cls, project, html, done, options, handlers):
+    """Render one range in a worker process. Returns its Fragment with the XML
+    as bytes, so that it can be sent back."""
+    from bs4 import BeautifulSoup
+
+    from IncrementalMarkdown2docx import render_portable_fragment
+
+    converter = cls(project, file_stream=io.BytesIO(), streaming=True, **options)
+    for tag, handler in handlers.items():
+        converter.register_handler(tag, handler)
+    soup = BeautifulSoup(html, "html.parser")
+
+    def render(state):
+        converter._eat(soup, state)
+
+    return render_portable_fragment(converter, render, {"table_of_contents_done": done})
+
+
+def render_parallel(converter, workers):
+    """Render converter.soup into converter.doc on workers processes, the way
+    converter.eat_soup() renders it. Returns the number of ranges."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    from IncrementalMarkdown2docx import splice_portable_fragment
+
+    sections = list(_sections(converter.soup.children))
+    states = _start_states(sections, converter.toc_indicator)
+    # parsing the HTML from one top-level heading to the next gives the nodes
+    # between them again, so a range is its slice of the HTML soup was made from
+    html = _sections_html(converter.html, sections)
+    if html is None:
+        html = ["".join(_serialize(node) for node in section) for section in sections]
+    ranges = split_ranges(html, workers * ranges_per_worker)
+    options = {
+        "template": converter.template,
+        "theme": converter.theme,
+        "bulk_tables": converter.bulk_tables,
+        "base_dir": converter.base_dir,
+        "image_pipeline": converter.image_pipeline,
+        "image_resolver": converter.image_resolver,
+    }
+    handlers = {
+        tag: handler
+        for tag, handler in converter.handlers.items()
+        if handler is not default_handlers.get(tag)
+    }
+    removed = set(default_handlers) - set(converter.handlers)
+    handlers.update(dict.fromkeys(removed))
+    cls, project = type(converter), converter.project
+    jobs = [
+        (cls, project, range_html, states[first], options, handlers)
+        for first, range_html in ranges
+    ]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = [executor.submit(_render_range, *job) for job in jobs]
+        try:
+            for future in futures:
+                splice_portable_fragment(converter.doc, future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return len(jobs)
@@ -2,24 +2,228 @@
 # coding: utf-8
 
 import ast
+import io
+import os
 import re
-import sys
 import subprocess
+import sys
+import time
+
+from Metrics import timed
+
+
+class CommandError(Exception):
+    """A ${command} could not be run, failed to finish in time, or the
+    commands as a whole ran past their deadline."""
+
+
+class MacroError(Exception):
+    """A macro line can not be read, a macro refers to a token that is not defined, or
+    macros refer to each other in a cycle."""
+
+
+def resolve_macros(macros, substitute_pattern=r'__\w+__', resolved=None, lines=None,
+                   source=None):
+    """Expand the __tokens__ in every macro value, each macro exactly once, in
+    dependency order. resolved holds macros that are already fully expanded, such as a
+    shared macro library, and is used without being expanded again. lines maps macro
+    names to the line they were defined on, for error messages.
+    Returns a new dict of the expanded macros. Raises MacroError on a name or value
+    that is not a string, an undefined token or a cycle.
+    """
+    pattern = re.compile(substitute_pattern)
+    resolved = resolved or {}
+    lines = lines or {}
+    expanded = {}
+
+    def where(name):
+        return f' ({source} line {lines[name]})' if name in lines else ''
+
+    def value_of(token):
+        return expanded[token] if token in expanded else resolved[token]
+
+    for name, value in macros.items():
+        if not isinstance(name, str) or not isinstance(value, str):
+            raise MacroError(f'Macro {name!r}: {value!r} is not a string{where(name)}')
+    for root in macros:
+        if root in expanded:
+            continue
+        path = [root]
+        on_path = {root}
+        stack = [iter(pattern.findall(macros[root]))]
+        while stack:
+            name = path[-1]
+            for token in stack[-1]:
+                if token in expanded or (token in resolved and token not in macros):
+                    continue
+                if token not in macros:
+                    raise MacroError(f'Undefined token {token} in macro {name}{where(name)}')
+                if token in on_path:
+                    cycle = path[path.index(token):] + [token]
+                    raise MacroError('Macro cycle ' + ' -> '.join(
+                        f'{name}{where(name)}' for name in cycle))
+                path.append(token)
+                on_path.add(token)
+                stack.append(iter(pattern.findall(macros[token])))
+                break
+            else:
+                stack.pop()
+                on_path.discard(path.pop())
+                expanded[name] = pattern.sub(lambda m: value_of(m.group()), macros[name])
+    return {name: expanded[name] for name in macros}
+
+
+def shared_macros(projects, macro_library=None):
+    """One macro scope for several documents, such as the chapters of a manual: the
+    macros of every project, a later definition replacing an earlier one, expanded
+    together on top of macro_library. Pass the result to each document as its
+    macro_library, so a chapter may use the macros of any other while its own
+    definitions still come first. Raises MacroError as resolve_macros() does."""
+    macros = {}
+    for project in projects:
+        macros.update(PreprocessMarkdown2docx(project, expand_macros=False).macros)
+    macro_library = macro_library or {}
+    return {**macro_library,
+            **resolve_macros(macros, PreprocessMarkdown2docx.substitute_pattern, macro_library)}
+
 
+def _run_command(command, timeout, deadline_at=None, cwd=None, metrics=None):
+    with timed(metrics, 'command', command=command):
+        return _run_command_untimed(command, timeout, deadline_at, cwd)
 
-def _do_execute(commands):
-    for command in commands:
-        command_result = subprocess.run(command.split(), capture_output=True, text=True)
-        # yield command_result.stdout.split('\n')
-        yield command_result.stdout.strip()
+
+def _run_command_untimed(command, timeout, deadline_at=None, cwd=None):
+    if deadline_at is not None:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise CommandError(f'Deadline passed before command "{command}" could start')
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    try:
+        command_result = subprocess.run(command.split(), capture_output=True, text=True,
+                                        timeout=timeout, cwd=cwd)
+    except subprocess.TimeoutExpired:
+        raise CommandError(f'Command "{command}" timed out after {timeout:.1f}s') from None
+    except OSError as e:
+        raise CommandError(f'Command "{command}" could not be run: {e}') from None
+    # return command_result.stdout.split('\n')
+    return command_result.stdout.strip()
+
+
+def _do_execute(commands, parallelism=8, timeout=None, deadline=None, cwd=None, metrics=None):
+    """Run each of the unique commands once, up to parallelism at a time, in the
+    directory cwd (the current directory if None). Each command is timed into
+    metrics, a Metrics.MetricsSink, if one is given.
+    timeout applies to every command, deadline to the run as a whole.
+    Returns a dict of command -> output."""
+    commands = list(dict.fromkeys(commands))
+    if not commands:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor, wait  # slow to import, often unused
+
+    deadline_at = None if deadline is None else time.monotonic() + deadline
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(commands)))) as executor:
+        futures = {executor.submit(_run_command, command, timeout, deadline_at, cwd,
+                                   metrics): command
+                   for command in commands}
+        done, not_done = wait(futures, timeout=deadline)
+        for future in not_done:
+            future.cancel()
+        if not_done:
+            pending = ', '.join(f'"{futures[future]}"' for future in not_done)
+            raise CommandError(f'Commands did not finish within {deadline}s: {pending}')
+        return {futures[future]: future.result() for future in futures}
+
+
+async def _run_command_async(command, timeout, deadline_at=None, cwd=None, metrics=None):
+    """_run_command() without blocking the event loop. The command is killed if
+    it times out or the task running it is cancelled."""
+    import asyncio
+
+    with timed(metrics, 'command', command=command):
+        if deadline_at is not None:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise CommandError(f'Deadline passed before command "{command}" could start')
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command.split(), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, cwd=cwd)
+        except OSError as e:
+            raise CommandError(f'Command "{command}" could not be run: {e}') from None
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            raise CommandError(f'Command "{command}" timed out after {timeout:.1f}s') from None
+        finally:
+            if process.returncode is None:  # timed out or cancelled
+                process.kill()
+                await asyncio.shield(process.wait())
+        return stdout.decode(errors='replace').strip()
+
+
+async def _do_execute_async(commands, parallelism=8, timeout=None, deadline=None, cwd=None,
+                            metrics=None):
+    """_do_execute() as a coroutine: the commands run as asyncio subprocesses, up to
+    parallelism at a time. If one fails or the caller is cancelled, the others are
+    cancelled and their processes killed."""
+    import asyncio
+
+    commands = list(dict.fromkeys(commands))
+    if not commands:
+        return {}
+    deadline_at = None if deadline is None else time.monotonic() + deadline
+    slots = asyncio.Semaphore(max(1, parallelism))
+
+    async def run(command):
+        async with slots:
+            return await _run_command_async(command, timeout, deadline_at, cwd, metrics)
+
+    tasks = [asyncio.ensure_future(run(command)) for command in commands]
+    try:
+        done, not_done = await asyncio.wait(tasks, timeout=deadline,
+                                            return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        if not_done:
+            pending = ', '.join(f'"{command}"' for command, task in zip(commands, tasks)
+                                if task in not_done)
+            raise CommandError(f'Commands did not finish within {deadline}s: {pending}')
+        return {command: task.result() for command, task in zip(commands, tasks)}
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)  # let them kill their processes
 
 
 class PreprocessMarkdown2docx:
     """Read a marked up markdown file looking for comment blocks containing macros in the form 
     {'__*__':'value'}
     and values * or commands in the form ${* [__*__]...}
-    Resolve all values for token substitution leaving a dictionary of macros and commands that
-    may or may not have had tokens expanded.
+    Resolve all values for token substitution leaving a dictionary of macros and commands
+    with every token expanded.
+
+    Macros shared by many documents can be resolved once and passed in as macro_library,
+    e.g. PreprocessMarkdown2docx('common').macros. The document's own macros take
+    precedence over the library's.
+
+    With a CommandCache, command outputs are reused between runs. A command's cache entry
+    can be tuned in the macro block with a line such as
+    {'${git describe}': {'ttl': 3600, 'env': ['GIT_DIR'], 'files': ['.git/HEAD']}}
+    or turned off with {'${date}': {'cache': False}}
+
+    Everything read from the file is kept on the instance, so documents can be
+    preprocessed on several threads at once. Errors are raised as MacroError or
+    CommandError, never by exiting. ${commands} run in cwd, the current directory
+    if None; pass the document's directory rather than calling os.chdir() from
+    a thread.
+
+    Markdown already in memory is passed as text; project then only names it in
+    error messages.
+
+    With a metrics sink (see Metrics.py) the stages of preprocessing, every
+    command and the number of macro substitutions are reported to it.
     """
     
     file = None
@@ -32,119 +236,247 @@ class PreprocessMarkdown2docx:
     substitute_pattern = r'__\w+__'  # how to find __token__ for substitution
     command_pattern = r'\$\{([^\}]+)\}'  # how to find ${commands}
     command_tokens = r'(\$\{[^\}]+\})'  # Captures the entire command token
-    expanded_commands = {}
+    command_parallelism = 8  # how many ${commands} may run at once
+    command_timeout = 60  # seconds allowed for each command, None for no limit
+    commands_deadline = 300  # seconds allowed for all the commands, None for no limit
     
-    def __init__(self, project):
+    def __init__(self, project, command_cache=None, macro_library=None, cwd=None,
+                 metrics=None, text=None, expand_macros=True):
         self.file = '.'.join([project, 'md'])
+        self.text = text  # the markdown itself, instead of reading self.file
+        self.cwd = cwd
+        self.metrics = metrics
+        self.error = 'No error'
+        self.command_cache = command_cache
+        self.macro_library = macro_library or {}
+        self.command_options = {}  # command -> cache options from the macro block
+        self.macro_lines = {}  # macro -> line it is defined on
+        self._scanned = None
+        self._matcher = None  # (macro names, their compiled alternation)
+        self._options = None  # command as written and as expanded -> its options
         self.macros = self.get_macros()
         self.substitute_pattern_compiled = re.compile(self.substitute_pattern)
         self.command_pattern_compiled = re.compile(self.command_pattern)
-        self.expanded_commands = self.do_token_substitutions()
+        # without expand_macros the macros are left as written, see shared_macros()
+        self.expanded_commands = self.do_token_substitutions() if expand_macros else None
         self.command_tokens_compiled = re.compile(self.command_tokens)
-        self.error = 'No error'
         
-    def get_macros(self):
+    def _scan(self):
+        """Read the file once, splitting it into the macros and the markdown without the
+        macro block. The MaCrOs and END_MaCrOs marker lines stay in the markdown."""
         macros_dict = {}
-        with open(self.file) as f:
-            in_a_macro_block = False
-            in_a_pre_block = False
-            for n, line in enumerate(f):
-                line = line.strip()
-                if line.startswith('```') and not in_a_pre_block:
-                    in_a_pre_block = True
-                if line.startswith('```') and in_a_pre_block:
-                    in_a_pre_block = False
-                if in_a_pre_block:
-                    continue
-                if line.startswith(self.macro_start_token):
-                    in_a_macro_block = True
-                    continue
-                if line.startswith(self.macro_end_token):
-                    in_a_macro_block = False
-                if line and len(line):
-                    if not line.startswith('#'):
-                        if not line.startswith('//'):
-                            if in_a_macro_block:
-                                try:
-                                    k, v = list(ast.literal_eval(line).items())[0]
-                                    macros_dict[k] = v
-                                except AttributeError as e:
-                                    message = f'Attribute ERROR {e} in {file} on line {n}:{line}'
-                                    self.error = message
-                                    print(message, file=sys.stderr)
-                                    exit(1)
-                                except SyntaxError:
-                                    message = f'Syntax ERROR in {file} on line {n}:{line}'
-                                    self.error = message
-                                    print(message, file=sys.stderr)
-                                    exit(1)
-        return macros_dict
-
-    def get_all_but_macros(self):
         markdown = []
-        with open(self.file) as f:
+        with open(self.file) if self.text is None else io.StringIO(self.text, None) as f:
             in_a_macro_block = False
-            in_a_pre_block = False
-            for line in f:
+            for n, line in enumerate(f, 1):
+                line = line.rstrip('\n')
                 line_copy = line.strip()
-                if line_copy.startswith('```') and not in_a_pre_block:
-                    in_a_pre_block = True
-                if line_copy.startswith('```') and in_a_pre_block:
-                    in_a_pre_block = False
-                if line_copy.startswith(self.macro_start_token) and not in_a_pre_block:
+                if line_copy.startswith(self.macro_start_token):
                     in_a_macro_block = True
-                    markdown.append(line.rstrip('\n'))
+                    markdown.append(line)
                     continue
-                if line_copy.startswith(self.macro_end_token) and not in_a_pre_block:
+                if line_copy.startswith(self.macro_end_token):
                     in_a_macro_block = False
-                if not in_a_macro_block or in_a_pre_block:
-                    markdown.append(line.rstrip('\n'))
-        return markdown
-    
+                if not in_a_macro_block:
+                    markdown.append(line)
+                    continue
+                if not line_copy or line_copy.startswith(('#', '//')):
+                    continue
+                try:
+                    entry = ast.literal_eval(line_copy)
+                except (SyntaxError, ValueError):
+                    self.error = f'Syntax ERROR in {self.file} on line {n}:{line_copy}'
+                    raise MacroError(self.error) from None
+                if not isinstance(entry, dict) or len(entry) != 1:
+                    self.error = (f'Macro ERROR, not one {{key: value}} in {self.file} '
+                                  f'on line {n}:{line_copy}')
+                    raise MacroError(self.error)
+                (k, v), = entry.items()
+                if not isinstance(k, str) or not isinstance(v, (str, dict)):
+                    self.error = (f'Macro ERROR, key and value must be strings in {self.file} '
+                                  f'on line {n}:{line_copy}')
+                    raise MacroError(self.error)
+                if isinstance(v, dict):
+                    self.command_options[k[2:-1]] = v
+                    continue
+                macros_dict[k] = v
+                self.macro_lines[k] = n
+        self._scanned = macros_dict, markdown
+        return self._scanned
+
+    def _scanned_file(self):
+        if self._scanned is None:
+            with timed(self.metrics, 'preprocess.scan'):
+                self._scan()
+        return self._scanned
+
+    def get_macros(self):
+        macros_dict, _ = self._scanned_file()
+        return dict(macros_dict)
+
+    def get_all_but_macros(self):
+        _, markdown = self._scanned_file()
+        return list(markdown)
+
     def do_token_substitutions(self):
-        expanded_commands_dict = {}
-        for k, v in self.macros.items():
-            tokens = self.substitute_pattern_compiled.findall(v)
-            for token in tokens:
-                if len(token):
-                    try:
-                        v = v.replace(token, self.macros[token])
-                        expanded_commands_dict[k] = v
-                    except KeyError as e:
-                        message = f'Key ERROR {e} in {self.file} using token {token}'
-                        self.error = message
-                        print(message, file=sys.stderr)
-                        exit(1)
-        self.macros.update(expanded_commands_dict)
+        """Expand the tokens in every macro value, however deeply they are nested."""
+        try:
+            with timed(self.metrics, 'preprocess.macros'):
+                expanded = resolve_macros(self.macros, self.substitute_pattern,
+                                          self.macro_library, self.macro_lines, self.file)
+        except MacroError as e:
+            self.error = str(e)
+            raise
+        self.macros = {**self.macro_library, **expanded}
         return self.macros
 
+    def _token_matcher(self):
+        """One alternation of every macro name, longest first so that no name hides
+        a longer one it is a prefix of. Compiled once for the names in self.macros."""
+        names = tuple(self.macros)
+        if self._matcher is None or self._matcher[0] != names:
+            ordered = sorted(names, key=len, reverse=True)
+            self._matcher = names, re.compile('|'.join(re.escape(name) for name in ordered))
+        return self._matcher[1]
+
     def do_substitute_tokens(self, markdown):
         """for each line in markdown, if a token found in macros is present, then substitute the value
-        of the token.
+        of the token. All the tokens in a line are replaced in a single pass.
         """
-        for i, line in enumerate(markdown.copy()):
-            for k, v in self.macros.items():
-                if line.find(k) >= 0:
-                    line = line.replace(k, v)
-                    markdown[i] = line
+        if not self.macros:
+            return markdown
+        with timed(self.metrics, 'preprocess.substitute'):
+            matcher = self._token_matcher()
+            macros = self.macros
+
+            def replace(m):
+                return macros[m.group()]
+
+            if self.metrics is None:
+                for i, line in enumerate(markdown):
+                    markdown[i] = matcher.sub(replace, line)
+                return markdown
+            substitutions = 0
+            for i, line in enumerate(markdown):
+                markdown[i], n = matcher.subn(replace, line)
+                substitutions += n
+        self.metrics.count('macro_substitutions', substitutions)
         return markdown
 
+    def _substitute_line(self, line):
+        if not self.macros:
+            return line
+        return self._token_matcher().sub(lambda m: self.macros[m.group()], line)
+
     def do_execute_commands(self, markdown):
-        """For each line in markdown, if a command token is present,
-        then execute the command and insert the output of the command.
+        """Collect the command tokens from the whole of markdown, execute each
+        distinct command once (concurrently), then replace every token with the
+        output of its command. Raises CommandError if a command can not be run
+        or does not finish in time.
         """
-        modified_markdown = []
-        for i, line in enumerate(markdown.copy()):
-            execute = self.command_pattern_compiled.findall(line)
-            if execute:
-                command_token_list = self.command_tokens_compiled.findall(line)
-                outputs = list(_do_execute(execute))
-                for index, command in enumerate(command_token_list):
-                    line = line.replace(command, outputs[index])
-            modified_markdown.append(line)
-        return modified_markdown
+        with timed(self.metrics, 'preprocess.commands'):
+            return self._execute_commands(markdown)
+
+    async def do_execute_commands_async(self, markdown):
+        """do_execute_commands() for an asyncio event loop, which it does not block:
+        the commands run as asyncio subprocesses. Cancelling the task kills them."""
+        with timed(self.metrics, 'preprocess.commands'):
+            commands = self._commands(markdown)
+            outputs, cache_keys = self._cached_outputs(commands)
+            executed = await _do_execute_async(
+                [command for command in commands if command not in outputs],
+                self.command_parallelism, self.command_timeout, self.commands_deadline,
+                self.cwd, self.metrics)
+            return self._with_outputs(markdown, outputs, executed, cache_keys)
+
+    def _commands(self, markdown):
+        return [command for line in markdown if '${' in line
+                for command in self.command_pattern_compiled.findall(line)]
+
+    def _execute_commands(self, markdown):
+        commands = self._commands(markdown)
+        outputs, cache_keys = self._cached_outputs(commands)
+        executed = _do_execute([command for command in commands if command not in outputs],
+                               self.command_parallelism, self.command_timeout,
+                               self.commands_deadline, self.cwd, self.metrics)
+        return self._with_outputs(markdown, outputs, executed, cache_keys)
+
+    def _with_outputs(self, markdown, outputs, executed, cache_keys):
+        """Store the outputs of the executed commands in the cache and replace every
+        command token in markdown with its output."""
+        if self.metrics is not None:
+            self.metrics.count('commands_run', len(executed))
+            self.metrics.count('commands_cached', len(outputs))
+        for command, output in executed.items():
+            if command in cache_keys:
+                self.command_cache.put(cache_keys[command], command, output,
+                                       self._command_option(command, 'ttl'))
+        outputs.update(executed)
+        if not outputs:
+            return list(markdown)
+        return [self.command_pattern_compiled.sub(lambda m: outputs[m.group(1)], line)
+                if '${' in line else line for line in markdown]
+
+    def _command_option(self, command, option, default=None):
+        if self._options is None:
+            # a command matches the first entry naming it, as written or with its
+            # macros expanded
+            self._options = {}
+            for k, options in reversed(self.command_options.items()):
+                self._options[self._substitute_line(k)] = options
+                self._options[k] = options
+        options = self._options.get(command)
+        return default if options is None else options.get(option, default)
+
+    def _cached_outputs(self, commands):
+        """Look up commands in the command cache. Returns the outputs found and the
+        cache keys to store the rest under."""
+        outputs = {}
+        cache_keys = {}
+        if self.command_cache is None:
+            return outputs, cache_keys
+        cwd = os.path.abspath(self.cwd or os.getcwd())
+        for command in dict.fromkeys(commands):
+            if not self._command_option(command, 'cache', True):
+                continue
+            key = self.command_cache.key(command, cwd, self._command_option(command, 'env', ()),
+                                         self._command_option(command, 'files', ()))
+            output = self.command_cache.get(key)
+            if output is None:
+                cache_keys[command] = key
+            else:
+                outputs[command] = output
+        return outputs, cache_keys
+
+
+def main(argv=None):
+    """Write the markdown with its macros and ${commands} expanded, without loading
+    anything needed to make a docx: markdown2docx-preprocess hello > hello_pp.md"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Expand the macros and ${commands} of a markdown file, without converting it.')
+    parser.add_argument('project', help='the markdown file, with or without .md')
+    parser.add_argument('-o', '--output', help='write the markdown here rather than to stdout')
+    parser.add_argument('--no-commands', action='store_true', help='leave ${commands} as they are')
+    args = parser.parse_args(argv)
+    project = args.project[:-3] if args.project.endswith('.md') else args.project
+    try:
+        ppm2w = PreprocessMarkdown2docx(project, cwd=os.path.dirname(project) or None)
+        markdown = ppm2w.do_substitute_tokens(ppm2w.get_all_but_macros())
+        if not args.no_commands:
+            markdown = ppm2w.do_execute_commands(markdown)
+    except (OSError, MacroError, CommandError) as e:
+        print(f'ERROR {type(e).__name__}: {e}', file=sys.stderr)
+        return 1
+    text = '\n'.join(markdown) + '\n'
+    if args.output is None:
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w', encoding='utf8') as output_fd:
+            output_fd.write(text)
+    return 0
 
 
 if __name__ == '__main__':
-    ppm2w = PreprocessMarkdown2docx('hello.md')
-    print(ppm2w.do_token_substitutions())
+    sys.exit(main())
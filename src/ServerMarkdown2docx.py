@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import collections
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+"""
+    A long running conversion server. Worker processes are started once, import
+    docx, bs4, markdown2 and PIL and build the styled base document before the
+    first request, so a request only pays for its own conversion.
+
+        $ markdown2docx-server --port 8750 --workers 4
+        $ curl --data-binary @hello.md localhost:8750/convert > hello.docx
+        $ curl localhost:8750/stats
+
+    POST /convert takes the markdown as the body, or JSON:
+        {"markdown": "...", "macros": {"__A__": "..."},
+         "images": {"lenna.png": "<base64>"}, "engine": "direct"}
+    and answers with the docx. At most workers + queue_size requests are taken
+    at once; more are turned away with 503 and Retry-After. A request that runs
+    longer than the timeout is stopped with 504, and every worker is replaced
+    after max_jobs conversions to keep memory in check (before Python 3.11 the
+    whole pool is replaced after max_jobs conversions per worker).
+"""
+
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class ServerBusy(Exception):
+    """Every worker is busy and the queue is full."""
+
+
+class ConversionTimeout(Exception):
+    """A conversion ran past its time limit."""
+
+
+_worker_options = {}
+# ProcessPoolExecutor replaces a worker after max_tasks_per_child jobs from
+# Python 3.11 on; before that the server replaces the pool
+_recycles_workers = sys.version_info >= (3, 11)
+
+
+def _warm_worker(template, allow_commands):
+    """Runs once in each worker process as it starts."""
+    from Markdown2docx import base_document
+
+    base_document(template)
+    _worker_options.update(template=template, allow_commands=allow_commands)
+
+
+def _time_limit(signum, frame):
+    raise TimeoutError("conversion timed out")
+
+
+def _static_toc(value):
+    """The static_toc of a request: "links" or "pages", or False for a false
+    value such as a missing one, null, "0" or "false". Raises ValueError for
+    anything else."""
+    if value in ("links", "pages"):
+        return value
+    if not value or value in ("0", "false", "no"):
+        return False
+    raise ValueError(f'static_toc must be "links" or "pages", not {value!r}')
+
+
+def _convert_job(request, timeout):
+    """Convert one request in a worker process. request holds markdown, and
+    optionally macros, images (src -> bytes) and engine / bulk_tables /
+    static_toc."""
+    from Markdown2docx import convert
+
+    images = request.get("images") or {}
+    limited = timeout is not None and hasattr(signal, "setitimer")
+    if limited:
+        signal.signal(signal.SIGALRM, _time_limit)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return convert(
+            request["markdown"],
+            macros=request.get("macros"),
+            resolve_image=images.get,
+            run_commands=_worker_options.get("allow_commands", False),
+            template=_worker_options.get("template"),
+            engine=request.get("engine", "soup"),
+            bulk_tables=bool(request.get("bulk_tables", False)),
+            static_toc=_static_toc(request.get("static_toc")),
+        )
+    finally:
+        if limited:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ConversionServer:
+    """A pool of warm worker processes with a bounded queue in front of it.
+    convert() may be called from many threads at once."""
+
+    latency_window = 1000  # requests kept for the latency percentiles
+    throughput_window = 60  # seconds
+
+    def __init__(
+        self,
+        workers=None,
+        queue_size=16,
+        timeout=60,
+        max_jobs=100,
+        template=None,
+        allow_commands=False,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.template = template
+        self.allow_commands = allow_commands
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._jobs = 0  # submitted to the current pool
+        self._started = time.monotonic()
+        self._latencies = collections.deque(maxlen=self.latency_window)
+        self._finished = collections.deque()  # completion times in the throughput window
+        self._counts = collections.Counter()
+        self._in_flight = 0
+
+    def _new_pool(self):
+        self._jobs = 0
+        options = {}
+        if _recycles_workers:
+            options["max_tasks_per_child"] = self.max_jobs
+        # workers are recycled, which needs a start method other than fork
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_warm_worker,
+            initargs=(self.template, self.allow_commands),
+            **options,
+        )
+
+    def start(self):
+        """Start the workers and wait until every one of them is warm."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            pool = self._pool
+        warm = [pool.submit(os.getpid) for _ in range(self.workers)]
+        for future in warm:
+            future.result()
+        return self
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, request):
+        retired = None
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+            elif not _recycles_workers and self.max_jobs:
+                if self._jobs >= self.max_jobs * self.workers:
+                    retired, self._pool = self._pool, self._new_pool()
+            self._jobs += 1
+            pool = self._pool
+        if retired is not None:  # it finishes the jobs it has, then exits
+            retired.shutdown(wait=False)
+        try:
+            return pool.submit(_convert_job, request, self.timeout)
+        except BrokenProcessPool:
+            with self._lock:  # a worker died, e.g. killed for its memory
+                broken = self._pool is pool
+                if broken:
+                    self._pool = self._new_pool()
+                new_pool = self._pool
+            if broken:  # let go of its management thread and remaining workers
+                pool.shutdown(wait=False)
+            return new_pool.submit(_convert_job, request, self.timeout)
+
+    def convert(self, request):
+        """Convert request (see _convert_job) and return the docx bytes.
+        Raises ServerBusy when the queue is full and ConversionTimeout when
+        the conversion takes too long; conversion errors are raised as is."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counts["rejected"] += 1
+            raise ServerBusy(f"{self.workers} workers busy and {self.queue_size} requests queued")
+        started = time.monotonic()
+        with self._lock:
+            self._counts["requests"] += 1
+            self._in_flight += 1
+        outcome = "failed"
+        try:
+            # the worker stops itself at the timeout, the wait covers the
+            # requests queued ahead of this one and sending the result back
+            wait = None if self.timeout is None else self._queue_wait() + 1
+            future = self._submit(request)
+            try:
+                result = future.result(timeout=wait)
+            except (TimeoutError, FutureTimeout) as e:  # raised here or in the worker
+                future.cancel()
+                outcome = "timeouts"
+                raise ConversionTimeout(str(e) or f"no result within {wait:.0f}s") from None
+            outcome = "completed"
+            return result
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._in_flight -= 1
+                self._counts[outcome] += 1
+                if outcome == "completed":
+                    self._latencies.append(finished - started)
+                    self._finished.append(finished)
+            self._slots.release()
+
+    def _queue_wait(self):
+        """Roughly how long a request queued now waits for a worker."""
+        with self._lock:
+            queued = max(0, self._in_flight - self.workers)
+        return (queued // self.workers + 1) * (self.timeout or 0)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._finished and self._finished[0] < now - self.throughput_window:
+                self._finished.popleft()
+            latencies = sorted(self._latencies)
+            counts = dict(self._counts)
+            in_flight = self._in_flight
+            recent = len(self._finished)
+        uptime = now - self._started
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+        return {
+            "uptime_seconds": uptime,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": in_flight,
+            "queued": max(0, in_flight - self.workers),
+            "requests": counts.get("requests", 0),
+            "completed": counts.get("completed", 0),
+            "failed": counts.get("failed", 0),
+            "timeouts": counts.get("timeouts", 0),
+            "rejected": counts.get("rejected", 0),
+            "throughput_per_second": recent / min(uptime, self.throughput_window)
+            if uptime
+            else 0.0,
+            "latency_seconds": {f"p{p}": percentile(p) for p in (50, 90, 95, 99)},
+        }
+
+
+def parse_request(body, content_type, query):
+    """The conversion request for an HTTP body: JSON with the pictures in
+    base64, or the markdown itself with options in the query string."""
+    if content_type.split(";")[0].strip() == "application/json":
+        request = json.loads(body)
+        if not isinstance(request, dict) or not isinstance(request.get("markdown"), str):
+            raise ValueError('expected a JSON object with "markdown"')
+        request["images"] = {
+            src: base64.b64decode(data) for src, data in (request.get("images") or {}).items()
+        }
+        request["static_toc"] = _static_toc(request.get("static_toc"))
+        return request
+    options = {name: values[-1] for name, values in parse_qs(query).items()}
+    return {
+        "markdown": body,
+        "engine": options.get("engine", "soup"),
+        "bulk_tables": options.get("bulk_tables", "") in ("1", "true", "yes"),
+        "static_toc": _static_toc(options.get("static_toc")),
+    }
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """POST /convert, GET /stats and GET /health for the ConversionServer
+    in self.server.conversions."""
+
+    max_body = 64 << 20
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _reply(self, status, body, content_type="application/json", headers=()):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = json.dumps({"error": body}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self._reply(200, self.server.conversions.stats())
+        elif path == "/health":
+            self._reply(200, {"ok": True})
+        else:
+            self._reply(404, "not found")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/convert":
+            self._reply(404, "not found")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.max_body:
+            self._reply(413, f"request larger than {self.max_body} bytes")
+            return
+        body = self.rfile.read(length)
+        try:
+            request = parse_request(body, self.headers.get("Content-Type", ""), url.query)
+        except ValueError as e:
+            self._reply(400, str(e))
+            return
+        try:
+            docx_bytes = self.server.conversions.convert(request)
+        except ServerBusy as e:
+            self._reply(503, str(e), headers=[("Retry-After", "1")])
+        except ConversionTimeout as e:
+            self._reply(504, str(e))
+        except Exception as e:
+            status = 422 if type(e).__name__ in ("MacroError", "FileNotFoundError") else 500
+            self._reply(status, f"{type(e).__name__}: {e}")
+        else:
+            self._reply(200, docx_bytes, DOCX_TYPE)
+
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)  # there is no host name to look up
+        self.server_name, self.server_port = "localhost", 0
+
+    def get_request(self):
+        connection, _ = super().get_request()
+        return connection, ("unix", 0)
+
+
+def make_http_server(conversions, host="127.0.0.1", port=8750, socket_path=None):
+    """An HTTP server for conversions, on host:port or on a Unix socket."""
+    if socket_path is not None:
+        server = _UnixHTTPServer(socket_path, ConversionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ConversionHandler)
+    server.daemon_threads = True
+    server.conversions = conversions
+    return server
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve markdown to docx conversions.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8750)
+    parser.add_argument("--socket", help="listen on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds per request")
+    parser.add_argument("--max-jobs", type=int, default=100, help="jobs before a worker is replaced")
+    parser.add_argument("--template", help="a .docx to take the styles from")
+    parser.add_argument(
+        "--allow-commands", action="store_true", help="run ${commands} in the markdown"
+    )
+    args = parser.parse_args(argv)
+    conversions = ConversionServer(
+        args.workers,
+        args.queue_size,
+        args.timeout,
+        args.max_jobs,
+        args.template,
+        args.allow_commands,
+    ).start()
+    server = make_http_server(conversions, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{server.server_address[1]}"
+    print(f"serving on {where} with {conversions.workers} workers", file=sys.stderr)
+    signal.signal(signal.SIGTERM, _stop)  # shut the workers down on kill too
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        conversions.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
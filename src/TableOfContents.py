@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+import math
+import re
+
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+"""
+    Write the entries of the table of contents when the document is saved,
+    so that it shows without the field being updated in Word or LibreOffice.
+
+        project = Markdown2docx('manual', markdown, static_toc="pages")
+
+    The entries are what updating the TOC field would write: one per heading
+    of the body whose outline level the field's \\o switch takes in, in the
+    style "toc N" for its level, each a hyperlink to a _Toc bookmark put
+    around the heading. With page numbers the page is an estimate made from
+    the length of the text, pictures and tables and the page breaks, and is
+    written as a PAGEREF field. The TOC field itself stays, with the entries
+    as its result, so updating it in Word puts in the real page numbers.
+"""
+
+line_points = 14.0  # the height of a line of body text
+char_points = 6.0  # the average width of a character of body text
+_levels_re = re.compile(r'\\o\s+"(\d)-(\d)"')
+_twips_per_emu = 1 / 635
+_points_per_emu = 1 / 12700
+
+
+def _element(tag, text=None, **attributes):
+    element = OxmlElement(tag)
+    for name, value in attributes.items():
+        element.set(qn(f"w:{name}"), str(value))
+    if text is not None:
+        element.text = text
+        if tag in ("w:t", "w:instrText"):
+            element.set(qn("xml:space"), "preserve")
+    return element
+
+
+def _run(child):
+    run = _element("w:r")
+    run.append(child)
+    return run
+
+
+def _field_chars(paragraph):
+    """The fldCharType of every field character in the runs of paragraph,
+    leaving out those of the fields in its hyperlinks."""
+    return [
+        char.get(qn("w:fldCharType"))
+        for run in paragraph.iterchildren(qn("w:r"))
+        for char in run.iterchildren(qn("w:fldChar"))
+    ]
+
+
+def _find_field(body):
+    """The paragraphs the TOC field takes up, from the one it starts in to the
+    one it ends in, and its instruction; ([], None) if there is no field."""
+    paragraphs = list(body.iterchildren(qn("w:p")))
+    for n, paragraph in enumerate(paragraphs):
+        for instruction in paragraph.iter(qn("w:instrText")):
+            if (instruction.text or "").strip().startswith("TOC"):
+                break
+        else:
+            continue
+        for last in range(n, len(paragraphs)):
+            if "end" in _field_chars(paragraphs[last]):
+                return paragraphs[n : last + 1], instruction.text
+        return paragraphs[n : n + 1], instruction.text
+    return [], None
+
+
+def _paragraph_text(paragraph):
+    return "".join(text.text or "" for text in paragraph.iter(qn("w:t")))
+
+
+class _OutlineLevels:
+    """The outline level of paragraphs, 0 for level 1, from their own
+    properties or else their style and the styles it is based on."""
+
+    def __init__(self, doc):
+        self.styles = {
+            style.get(qn("w:styleId")): style
+            for style in doc.styles.element.iterchildren(qn("w:style"))
+        }
+        self.cache = {}
+
+    def _of_style(self, style_id):
+        if style_id not in self.cache:
+            self.cache[style_id] = None  # a style based on itself
+            style = self.styles.get(style_id)
+            level = None
+            if style is not None:
+                found = style.find(f"{qn('w:pPr')}/{qn('w:outlineLvl')}")
+                if found is not None:
+                    level = int(found.get(qn("w:val")))
+                else:
+                    based_on = style.find(qn("w:basedOn"))
+                    if based_on is not None:
+                        level = self._of_style(based_on.get(qn("w:val")))
+            self.cache[style_id] = level
+        return self.cache[style_id]
+
+    def __call__(self, paragraph):
+        properties = paragraph.find(qn("w:pPr"))
+        style_id = "Normal"
+        if properties is not None:
+            found = properties.find(qn("w:outlineLvl"))
+            if found is not None:
+                return int(found.get(qn("w:val")))
+            style = properties.find(qn("w:pStyle"))
+            if style is not None:
+                style_id = style.get(qn("w:val"))
+        return self._of_style(style_id)
+
+
+def _entry_style(doc, level):
+    """The ID of the style "toc level", which is added if doc lacks it."""
+    styles = doc.styles.element
+    name = f"toc {level}"
+    for style in styles.iterchildren(qn("w:style")):
+        found = style.find(qn("w:name"))
+        if found is not None and found.get(qn("w:val")).lower() == name:
+            return style.get(qn("w:styleId"))
+    style_id = f"TOC{level}"
+    style = _element("w:style", type="paragraph", styleId=style_id)
+    style.append(_element("w:name", val=name))
+    style.append(_element("w:basedOn", val="Normal"))
+    style.append(_element("w:next", val="Normal"))
+    style.append(_element("w:uiPriority", val=39))
+    style.append(_element("w:unhideWhenUsed"))
+    properties = _element("w:pPr")
+    properties.append(_element("w:spacing", after=100))
+    properties.append(_element("w:ind", left=220 * (level - 1)))
+    style.append(properties)
+    styles.append(style)
+    return style_id
+
+
+def _bookmark(paragraph, bookmarks):
+    """The name of the _Toc bookmark around paragraph, added if it has none.
+    bookmarks holds the names and the largest ID in the document."""
+    for start in paragraph.iterchildren(qn("w:bookmarkStart")):
+        if start.get(qn("w:name")).startswith("_Toc"):
+            return start.get(qn("w:name"))
+    bookmarks["id"] += 1
+    bookmark_id = bookmarks["id"]
+    name = f"_Toc{bookmark_id}"
+    while name in bookmarks["names"]:
+        name += "_"
+    bookmarks["names"].add(name)
+    start = _element("w:bookmarkStart", id=bookmark_id, name=name)
+    properties = paragraph.find(qn("w:pPr"))
+    if properties is None:
+        paragraph.insert(0, start)
+    else:
+        properties.addnext(start)
+    paragraph.append(_element("w:bookmarkEnd", id=bookmark_id))
+    return name
+
+
+def _existing_bookmarks(body):
+    starts = list(body.iter(qn("w:bookmarkStart")))
+    return {
+        "id": max((int(start.get(qn("w:id"))) for start in starts), default=0),
+        "names": {start.get(qn("w:name")) for start in starts},
+    }
+
+
+def _entry(text, bookmark, style_id, tab_position):
+    """An entry paragraph, and the text element of its page number or None."""
+    paragraph = _element("w:p")
+    properties = _element("w:pPr")
+    properties.append(_element("w:pStyle", val=style_id))
+    if tab_position is not None:
+        tabs = _element("w:tabs")
+        tabs.append(_element("w:tab", val="right", leader="dot", pos=tab_position))
+        properties.append(tabs)
+    paragraph.append(properties)
+    link = _element("w:hyperlink", anchor=bookmark, history=1)
+    link.append(_run(_element("w:t", text)))
+    page = None
+    if tab_position is not None:
+        page = _element("w:t", "")
+        link.append(_run(_element("w:tab")))
+        link.append(_run(_element("w:fldChar", fldCharType="begin")))
+        link.append(_run(_element("w:instrText", f" PAGEREF {bookmark} \\h ")))
+        link.append(_run(_element("w:fldChar", fldCharType="separate")))
+        link.append(_run(page))
+        link.append(_run(_element("w:fldChar", fldCharType="end")))
+    paragraph.append(link)
+    return paragraph, page
+
+
+def _paragraph_lines(paragraph, chars_per_line):
+    lines = max(1, math.ceil(len(_paragraph_text(paragraph)) / chars_per_line))
+    for extent in paragraph.iter(qn("wp:extent")):
+        lines += int(extent.get("cy")) * _points_per_emu / line_points
+    return lines
+
+
+def _table_lines(table, chars_per_line):
+    lines = 0
+    for row in table.iterchildren(qn("w:tr")):
+        cells = list(row.iterchildren(qn("w:tc")))
+        width = max(1, chars_per_line // max(1, len(cells)))
+        lines += max(
+            [
+                sum(_paragraph_lines(p, width) for p in cell.iterchildren(qn("w:p")))
+                for cell in cells
+            ],
+            default=1,
+        )
+    return lines
+
+
+def estimate_pages(doc, headings):
+    """The page each of the heading paragraphs is estimated to start on, as
+    {paragraph: page}. Every line of text is taken to be line_points high and
+    hold as many characters of char_points as the text width has room for."""
+    section = doc.sections[0]
+    height = section.page_height - section.top_margin - section.bottom_margin
+    width = section.page_width - section.left_margin - section.right_margin
+    lines_per_page = max(1, int(height * _points_per_emu // line_points))
+    chars_per_line = max(1, int(width * _points_per_emu // char_points))
+    headings = set(headings)
+    pages = {}
+    page, line = 1, 0.0
+    for element in doc.element.body.iterchildren():
+        properties = element.find(qn("w:pPr"))
+        if element.tag == qn("w:tbl"):
+            lines = _table_lines(element, chars_per_line)
+        elif element.tag == qn("w:p"):
+            if properties is not None and line:
+                if properties.find(qn("w:pageBreakBefore")) is not None:
+                    page, line = page + 1, 0.0
+            lines = _paragraph_lines(element, chars_per_line)
+            if element in headings:
+                pages[element] = page
+                lines += 1  # headings are larger and spaced out
+        else:
+            continue
+        line += lines
+        while line >= lines_per_page:
+            page, line = page + 1, line - lines_per_page
+        breaks = [
+            br for br in element.iter(qn("w:br")) if br.get(qn("w:type")) == "page"
+        ]
+        if properties is not None and properties.find(qn("w:sectPr")) is not None:
+            breaks.append(None)  # a section break starts a new page
+        for _ in breaks:
+            if line:
+                page, line = page + 1, 0.0
+    return pages
+
+
+def fill_table_of_contents(doc, page_numbers=False):
+    """Write the entries of the TOC field of doc as its result, bookmarking
+    the headings they link to. With page_numbers each entry ends in its
+    estimated page (see estimate_pages()). Entries written before are written
+    again. Returns the number of entries; 0, leaving doc as it is, if doc has
+    no TOC field or no headings for it."""
+    body = doc.element.body
+    field, instruction = _find_field(body)
+    if not field:
+        return 0
+    match = _levels_re.search(instruction)
+    first_level, last_level = (int(match[1]), int(match[2])) if match else (1, 9)
+    outline_level = _OutlineLevels(doc)
+    headings = []
+    for paragraph in body.iterchildren(qn("w:p")):
+        if paragraph in field:
+            continue
+        level = outline_level(paragraph)
+        if level is None or not first_level <= level + 1 <= last_level:
+            continue
+        text = _paragraph_text(paragraph).strip()
+        if text:
+            headings.append((paragraph, level + 1, text))
+    if not headings:
+        return 0
+
+    section = doc.sections[0]
+    tab_position = None
+    if page_numbers:
+        width = section.page_width - section.left_margin - section.right_margin
+        tab_position = int(width * _twips_per_emu)
+    bookmarks = _existing_bookmarks(body)
+    entries, page_texts = [], []
+    for paragraph, level, text in headings:
+        bookmark = _bookmark(paragraph, bookmarks)
+        entry, page = _entry(text, bookmark, _entry_style(doc, level), tab_position)
+        entries.append(entry)
+        page_texts.append(page)
+    first = entries[0]
+    starts = [
+        _run(_element("w:fldChar", fldCharType="begin")),
+        _run(_element("w:instrText", instruction)),
+        _run(_element("w:fldChar", fldCharType="separate")),
+    ]
+    for run in reversed(starts):
+        first.find(qn("w:pPr")).addnext(run)
+    end = _element("w:p")
+    end.append(_run(_element("w:fldChar", fldCharType="end")))
+    for paragraph in [*entries, end]:
+        field[0].addprevious(paragraph)
+    for paragraph in field:
+        body.remove(paragraph)
+
+    if page_numbers:
+        pages = estimate_pages(doc, [paragraph for paragraph, _, _ in headings])
+        for (paragraph, _, _), page in zip(headings, page_texts):
+            page.text = str(pages[paragraph])
+    return len(entries)
@@ -0,0 +1,90 @@
+"""Every way of rendering a document must write the same body as rendering
+markdown2's HTML of the whole document at once."""
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from Markdown2docx import Markdown2docx, split_markdown_blocks  # noqa: E402
+
+DOCUMENTS = {
+    "reference links": (
+        "# Title\n\nSee [the site][1] and [the docs][docs].\n\nMore text.\n\n"
+        '[1]: http://example.com\n[docs]: http://example.com/docs "Docs"\n\nAfter.\n'
+    ),
+    "reference link before its definition in a list": (
+        "* see [the site][1]\n* and more\n\n[1]: <http://example.com>\n"
+    ),
+    "fence in a list item": (
+        "# T\n\n* item one\n\n    ```\n    code here\n\n    more\n    ```\n\n"
+        "* item two\n\nPara.\n"
+    ),
+    "quote followed by indented code": (
+        "# T\n\n> quoted text\n\n    indented code\n\nPara.\n\nNext.\n"
+    ),
+    "tab in a paragraph": "# T\n\nA\ttabbed paragraph.\n\n* a\titem\n",
+    "table of contents indicator only in a link target": (
+        "# Intro\n\nSee [the list](http://example.com/contents).\n\n"
+        "The contents are below.\n\n## A\n\nText.\n\nTable of contents:\n\n## B\n"
+    ),
+    "table right after a paragraph": (
+        "Para with **bold** text.\n| a | b |\n|---|---|\n| 1 | 2 |\n"
+    ),
+    "setext heading after paragraph lines": "Para\nwith two lines\nSetext\n======\n",
+    "line break in a list item": "1. a\n2. b\nLine  \nbreak\n",
+    "quote in a list item": "* a\n* b\n> q1\n",
+    "rule after a list": "* a\n---\n",
+    "rule after an ordered list": "1. a\n2. b\n---\n",
+    "heading right below a list": "* a\n* b\n# Head\n",
+    "heading right below a quote": "> q1\n# Head\n",
+    "underlined heading line": "# Head\n---\n",
+    "loose list after a rule": "---\n* a\n\n* b\n",
+    "HTML block with blank lines": "<div>\n\nx\n\n</div>\n\nAfter.\n",
+    "list after a quote": "> * in quote\n\n  * two space\n  * indent\n\n* a\n\n* b\n",
+    "empty document": "",
+}
+
+
+def document_xml(markdown, **options):
+    output = io.BytesIO()
+    converter = Markdown2docx("test", markdown, file_stream=output, **options)
+    converter.eat_soup()
+    converter.save()
+    return zipfile.ZipFile(output).read("word/document.xml")
+
+
+@pytest.mark.parametrize("name", DOCUMENTS)
+def test_streaming_matches_soup(name):
+    markdown = DOCUMENTS[name]
+    assert document_xml(markdown, streaming=True) == document_xml(markdown)
+
+
+@pytest.mark.parametrize("name", DOCUMENTS)
+def test_direct_matches_soup(name):
+    markdown = DOCUMENTS[name]
+    assert document_xml(markdown, engine="direct") == document_xml(markdown)
+
+
+def test_streaming_lines_resolve_earlier_definitions():
+    markdown = "[1]: http://example.com\n\nSee [the site][1].\n"
+    lines = iter(markdown.splitlines())
+    assert document_xml(lines, streaming=True) == document_xml(markdown)
+
+
+def test_definitions_are_not_blocks():
+    definitions = []
+    blocks = list(split_markdown_blocks(DOCUMENTS["reference links"], definitions))
+    assert not any("http://" in block for block in blocks)
+    assert definitions == [
+        "[1]: http://example.com",
+        '[docs]: http://example.com/docs "Docs"',
+    ]
+
+
+def test_indented_fence_stays_in_its_list():
+    blocks = list(split_markdown_blocks(DOCUMENTS["fence in a list item"]))
+    assert blocks[1].startswith("* item one") and "* item two" in blocks[1]
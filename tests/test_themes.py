@@ -0,0 +1,58 @@
+"""A theme, or the deprecated style class attributes, decide the styles the
+body is written in."""
+import io
+import os
+import sys
+import warnings
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from Markdown2docx import Markdown2docx, Theme  # noqa: E402
+
+
+def paragraph_styles(converter_class=Markdown2docx, **options):
+    from docx import Document
+
+    output = io.BytesIO()
+    converter = converter_class(
+        "test", "para one\n\n> quoted\n", file_stream=output, **options
+    )
+    converter.eat_soup()
+    converter.save()
+    return {
+        paragraph.text: paragraph.style.name
+        for paragraph in Document(output).paragraphs
+        if paragraph.text
+    }
+
+
+def test_default_paragraph_style():
+    assert paragraph_styles()["para one"] == "Custom Body"
+
+
+def test_theme_body_style_reaches_paragraphs():
+    assert paragraph_styles(theme=Theme(style_body="Normal"))["para one"] == "Normal"
+
+
+def test_own_paragraph_style_is_kept():
+    theme = Theme(style_body="Normal", style_paragraph="Body Text")
+    assert paragraph_styles(theme=theme)["para one"] == "Body Text"
+
+
+def test_class_style_body_reaches_paragraphs():
+    class Converter(Markdown2docx):
+        style_body = "Normal"
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        styles = paragraph_styles(Converter)
+    assert styles["para one"] == "Normal"
+    assert any(issubclass(w.category, DeprecationWarning) for w in caught)
+
+
+def test_subclass_style_attributes_are_keyed():
+    class Extra(Theme):
+        style_extra = "Normal"
+
+    assert Extra().key() != Extra(style_extra="Body Text").key()